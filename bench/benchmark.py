@@ -0,0 +1,528 @@
+# Offline end-to-end benchmark for terabox.py.
+#
+# Runs the real bot pipeline (handle_message -> resolve -> aria2 -> split ->
+# upload) against local stand-ins:
+#   - a resolver serving TERABOX_API_URL / ALTERNATE_API_URL with ok, slow and failing modes
+#   - aria2: a fake JSON-RPC/WebSocket server, or a real aria2c fetching from the stand-in file server
+#   - Telegram: fake clients with configurable latency, bandwidth and FloodWait injection
+#
+# Usage: python bench/benchmark.py --users 20 --file-size 300M --sessions 2
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.parse
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+ARIA2_PORT = 6800
+
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return f"p50 {pick(0.5):7.2f}s  p90 {pick(0.9):7.2f}s  p99 {pick(0.99):7.2f}s  max {values[-1]:7.2f}s  (n={len(values)})"
+
+
+# ---------------------------------------------------------------- resolver stand-in
+
+def build_resolver_app(args):
+    async def resolve(request):
+        mode = args.primary if request.match_info["api"] == "primary" else args.alternate
+        if mode == "fail":
+            return web.Response(status=500)
+        if mode == "slow":
+            await asyncio.sleep(args.slow_delay)
+        await asyncio.sleep(args.resolver_delay)
+        share = request.query.get("url", "").rstrip("/").rsplit("/", 1)[-1]
+        expires = int(time.time()) + 8 * 3600
+        raise web.HTTPFound(f"/file/{share}{args.ext}?expires={expires}")
+
+    # Folder listing in the shape TERABOX_LIST_API_URL expects; every other
+    # file is a video so albums of both kinds are exercised
+    async def list_files(request):
+        share = request.query.get("url", "").rstrip("/").rsplit("/", 1)[-1]
+        files = [
+            {"file_name": f"{share}-{i}{'.mp4' if i % 2 else args.ext}", "size": args.file_size,
+             "direct_link": f"http://127.0.0.1:{args.resolver_port}/file/{share}-{i}{'.mp4' if i % 2 else args.ext}"}
+            for i in range(args.folder_files)
+        ]
+        return web.json_response({"files": files})
+
+    # Range-aware file server for real aria2c, throttled per connection
+    async def serve_file(request):
+        size = args.file_size
+        start, end = 0, size - 1
+        header = request.headers.get("Range")
+        if header and header.startswith("bytes="):
+            first, _, last = header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+        response = web.StreamResponse(status=206 if header else 200, headers={
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/octet-stream",
+        })
+        if header:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        chunk = b"\0" * 65536
+        position = start
+        while position <= end:
+            count = min(len(chunk), end - position + 1)
+            await response.write(chunk[:count])
+            position += count
+            if args.download_rate:
+                await asyncio.sleep(count / args.download_rate)
+        return response
+
+    app = web.Application()
+    app.router.add_route("*", "/api/{api}", resolve)
+    app.router.add_route("*", "/file/{name}", serve_file)
+    app.router.add_get("/list", list_files)
+    return app
+
+
+# ---------------------------------------------------------------- fake aria2
+
+class FakeAria2:
+    """Enough of aria2's JSON-RPC and WebSocket API for the bot: downloads grow
+    on disk at --download-rate and complete with an onDownloadComplete event"""
+
+    def __init__(self, args):
+        self.args = args
+        self.downloads = {}
+        self.sockets = []
+        self.counter = 0
+
+    def status(self, gid):
+        download = self.downloads[gid]
+        size = self.args.file_size
+        done = min(size, int((time.time() - download["started"]) * self.args.download_rate))
+        if done > download["written"]:
+            with open(download["path"], "r+b") as f:
+                f.seek(download["written"])
+                f.write(os.urandom(done - download["written"]))
+            download["written"] = done
+        complete = done >= size
+        if complete and not download["notified"]:
+            download["notified"] = True
+            for socket in self.sockets:
+                asyncio.ensure_future(socket.send_json({
+                    "jsonrpc": "2.0", "method": "aria2.onDownloadComplete", "params": [{"gid": gid}],
+                }))
+        piece_length = 1024 * 1024
+        pieces = (size + piece_length - 1) // piece_length
+        bits = "".join("1" if i < done // piece_length else "0" for i in range((pieces + 3) // 4 * 4))
+        return {
+            "gid": gid,
+            "status": "complete" if complete else "active",
+            "totalLength": str(size),
+            "completedLength": str(done),
+            "downloadSpeed": "0" if complete else str(self.args.download_rate),
+            "connections": "1",
+            "dir": os.path.dirname(download["path"]),
+            "files": [{
+                "index": "1", "path": download["path"], "length": str(size),
+                "completedLength": str(done), "selected": "true", "uris": [],
+            }],
+            "bitfield": "".join(f"{int(bits[i:i + 4], 2):x}" for i in range(0, len(bits), 4)),
+            "pieceLength": str(piece_length),
+            "numPieces": str(pieces),
+        }
+
+    def file_name(self, uri):
+        # Resolver URLs (the fallback when every resolver failed) carry the share
+        # in ?url=; file URLs already end in the name the resolver or listing gave
+        parsed = urllib.parse.urlsplit(uri)
+        share_url = urllib.parse.parse_qs(parsed.query).get("url")
+        if share_url:
+            return share_url[0].rstrip("/").rsplit("/", 1)[-1] + self.args.ext
+        return parsed.path.rsplit("/", 1)[-1]
+
+    def call(self, method, params):
+        if params and isinstance(params[0], str) and params[0].startswith("token:"):
+            params = params[1:]
+        if method == "aria2.addUri":
+            self.counter += 1
+            gid = f"{self.counter:016x}"
+            options = params[1] if len(params) > 1 else {}
+            directory = options.get("dir", self.args.download_dir)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, options.get("out") or f"{self.counter}-{self.file_name(params[0][0])}")
+            open(path, "wb").close()
+            self.downloads[gid] = {"started": time.time(), "path": path, "written": 0, "notified": False}
+            return gid
+        if method == "aria2.tellStatus":
+            return self.status(params[0])
+        if method in ("aria2.tellActive", "aria2.tellStopped"):
+            statuses = [self.status(gid) for gid in self.downloads]
+            active = method == "aria2.tellActive"
+            return [s for s in statuses if (s["status"] == "active") == active]
+        if method == "aria2.tellWaiting":
+            return []
+        if method == "aria2.getGlobalStat":
+            active = sum(1 for gid in self.downloads if self.status(gid)["status"] == "active")
+            return {"downloadSpeed": str(active * self.args.download_rate), "uploadSpeed": "0",
+                    "numActive": str(active), "numWaiting": "0", "numStopped": str(len(self.downloads) - active)}
+        if method in ("aria2.remove", "aria2.forceRemove", "aria2.removeDownloadResult"):
+            self.downloads.pop(params[0], None)
+            return params[0]
+        if method == "aria2.getGlobalOption":
+            return {}
+        if method.startswith("aria2.change"):
+            return "OK"
+        if method == "system.multicall":
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self.call(call["methodName"], call.get("params", []))])
+                except Exception as e:
+                    results.append({"code": 1, "message": str(e)})
+            return results
+        raise ValueError(f"Unsupported method {method}")
+
+    def build_app(self):
+        async def rpc(request):
+            payload = await request.json()
+            try:
+                result = self.call(payload["method"], payload.get("params", []))
+                return web.json_response({"jsonrpc": "2.0", "id": payload.get("id"), "result": result})
+            except Exception as e:
+                return web.json_response({"jsonrpc": "2.0", "id": payload.get("id"),
+                                          "error": {"code": 1, "message": str(e)}})
+
+        async def websocket(request):
+            socket = web.WebSocketResponse()
+            await socket.prepare(request)
+            self.sockets.append(socket)
+            async for _ in socket:
+                pass
+            self.sockets.remove(socket)
+            return socket
+
+        app = web.Application()
+        app.router.add_post("/jsonrpc", rpc)
+        app.router.add_get("/jsonrpc", websocket)
+        return app
+
+
+def serve_stand_ins(args):
+    async def main():
+        runners = [web.AppRunner(build_resolver_app(args))]
+        if args.aria2 == "fake":
+            runners.append(web.AppRunner(FakeAria2(args).build_app()))
+        for runner in runners:
+            await runner.setup()
+        await web.TCPSite(runners[0], "127.0.0.1", args.resolver_port).start()
+        if args.aria2 == "fake":
+            await web.TCPSite(runners[1], "127.0.0.1", ARIA2_PORT).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+# ---------------------------------------------------------------- fake Telegram
+
+class FakeMessage:
+    counter = 1000
+
+    def __init__(self, chat_id, text="", user_id=None):
+        FakeMessage.counter += 1
+        self.id = FakeMessage.counter
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.from_user = types.SimpleNamespace(id=user_id or chat_id, first_name="Bench", mention="@bench")
+        self.text = text
+        self.caption = None
+        self.entities = None
+        self.caption_entities = None
+        self.empty = False
+
+    async def reply_text(self, text, **kwargs):
+        await asyncio.sleep(telegram.args.telegram_latency)
+        return FakeMessage(self.chat.id, text)
+
+    async def edit_text(self, text, **kwargs):
+        telegram.edits += 1
+        await asyncio.sleep(telegram.args.telegram_latency)
+        telegram.maybe_flood()
+        self.text = text
+
+
+class FakeTelegram:
+    def __init__(self, args, flood_wait):
+        self.args = args
+        self.flood_wait = flood_wait
+        self.edits = 0
+        self.floods = 0
+        self.uploaded_bytes = 0
+        self.delivered = {}
+
+    def maybe_flood(self):
+        if random.random() < self.args.floodwait_rate:
+            self.floods += 1
+            raise self.flood_wait(value=self.args.floodwait_seconds)
+
+
+class FakeClient:
+    """Stands in for both the bot and user sessions"""
+
+    def __init__(self, name, premium=False):
+        self.name = name
+        self.me = types.SimpleNamespace(id=hash(name) & 0xFFFF, is_premium=premium)
+        self.is_connected = True
+
+    async def get_chat_member(self, chat_id, user_id):
+        from pyrogram.enums import ChatMemberStatus
+        return types.SimpleNamespace(status=ChatMemberStatus.MEMBER)
+
+    async def get_messages(self, chat_id, message_ids):
+        if isinstance(message_ids, list):
+            return [FakeMessage(chat_id) for _ in message_ids]
+        return FakeMessage(chat_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await asyncio.sleep(telegram.args.telegram_latency)
+        telegram.delivered.setdefault(chat_id, []).append((time.monotonic(), message_id))
+        return FakeMessage(chat_id)
+
+    async def copy_media_group(self, chat_id, from_chat_id, message_id, **kwargs):
+        await asyncio.sleep(telegram.args.telegram_latency)
+        telegram.delivered.setdefault(chat_id, []).append((time.monotonic(), message_id))
+        return [FakeMessage(chat_id)]
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        return [await self.upload(chat_id, item.media, None) for item in media]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(telegram.args.telegram_latency)
+        return FakeMessage(chat_id, text)
+
+    async def send_video(self, chat_id, media, caption="", progress=None, **kwargs):
+        return await self.upload(chat_id, media, progress)
+
+    async def send_document(self, chat_id, media, caption="", progress=None, **kwargs):
+        return await self.upload(chat_id, media, progress)
+
+    async def upload(self, chat_id, media, progress):
+        await asyncio.sleep(telegram.args.telegram_latency)
+        telegram.maybe_flood()
+        # Read the whole source like pyrogram would, paced at the configured uplink
+        stream = open(media, "rb") if isinstance(media, str) else media
+        try:
+            stream.seek(0, os.SEEK_END)
+            size = stream.tell()
+            stream.seek(0)
+            sent = 0
+            while True:
+                chunk = stream.read(512 * 1024)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                if telegram.args.upload_rate:
+                    await asyncio.sleep(len(chunk) / telegram.args.upload_rate)
+                if progress:
+                    await progress(sent, size)
+        finally:
+            if isinstance(media, str):
+                stream.close()
+        telegram.uploaded_bytes += size
+        return FakeMessage(chat_id)
+
+
+telegram = None
+
+
+# ---------------------------------------------------------------- driver
+
+class StageTimes:
+    def __init__(self):
+        self.waits = {}
+        self.holds = {}
+
+    def wrap(self, stage):
+        original = stage.slot
+
+        @asynccontextmanager
+        async def timed_slot(*args, **kwargs):
+            queued = time.monotonic()
+            async with original(*args, **kwargs):
+                granted = time.monotonic()
+                self.waits.setdefault(stage.name, []).append(granted - queued)
+                try:
+                    yield
+                finally:
+                    self.holds.setdefault(stage.name, []).append(time.monotonic() - granted)
+
+        stage.slot = timed_slot
+
+
+async def sample_disk(path, peak):
+    while True:
+        used = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    used += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        peak[0] = max(peak[0], used)
+        await asyncio.sleep(0.2)
+
+
+async def run_benchmark(args, tb):
+    global telegram
+    from pyrogram.errors import FloodWait
+    telegram = FakeTelegram(args, FloodWait)
+
+    bot = FakeClient("bot")
+    tb.app.me = bot.me
+    tb.upload_pool.sessions = []
+    tb.upload_pool.add(bot, "bot")
+    for i in range(args.sessions - 1):
+        tb.upload_pool.add(FakeClient(f"user{i + 1}", premium=True), f"user{i + 1}")
+    stage_times = StageTimes()
+    for stage in (tb.resolve_stage, tb.download_stage, tb.split_stage, tb.upload_stage):
+        stage_times.wrap(stage)
+
+    peak_disk = [0]
+    disk_task = asyncio.create_task(sample_disk(args.download_dir, peak_disk))
+    job_times = []
+
+    async def user_job(i):
+        await asyncio.sleep(i * args.arrival_interval)
+        share = "1bench" if args.same_link else f"1bench{i}"
+        message = FakeMessage(100000 + i, f"https://terabox.com/s/{share}")
+        started = time.monotonic()
+        await tb.handle_message(bot, message)
+        job_times.append((time.monotonic() - started, started, message.chat.id))
+
+    started = time.monotonic()
+    await asyncio.gather(*(user_job(i) for i in range(args.users)))
+    wall = time.monotonic() - started
+    # Let the status editor flush its final edits
+    while tb.status_editor.pending:
+        await asyncio.sleep(0.1)
+    disk_task.cancel()
+
+    first_part = []
+    for _, job_started, chat_id in job_times:
+        deliveries = telegram.delivered.get(chat_id)
+        if deliveries:
+            first_part.append(deliveries[0][0] - job_started)
+    delivered_jobs = sum(1 for _, _, chat_id in job_times if telegram.delivered.get(chat_id))
+
+    print()
+    print(f"==== {args.users} users, {format_bytes(args.file_size)} files, {args.sessions} upload sessions, aria2={args.aria2} ====")
+    print(f"wall time          {wall:.2f}s")
+    print(f"jobs delivered     {delivered_jobs}/{args.users}")
+    print(f"job latency        {percentiles([t for t, _, _ in job_times])}")
+    print(f"first part         {percentiles(first_part)}")
+    for name in ("resolve", "download", "split", "upload"):
+        print(f"{name + ' wait':<18} {percentiles(stage_times.waits.get(name, []))}")
+        print(f"{name + ' service':<18} {percentiles(stage_times.holds.get(name, []))}")
+    print(f"uploaded           {format_bytes(telegram.uploaded_bytes)} ({format_bytes(telegram.uploaded_bytes / wall)}/s)")
+    print(f"status edits       {telegram.edits}, FloodWaits injected {telegram.floods}")
+    print(f"peak RSS           {format_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)}")
+    print(f"peak disk          {format_bytes(peak_disk[0])}")
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for terabox.py")
+    parser.add_argument("--users", type=int, default=10, help="concurrent synthetic users")
+    parser.add_argument("--arrival-interval", type=float, default=0.0, help="seconds between user arrivals")
+    parser.add_argument("--same-link", action="store_true", help="every user sends the same share")
+    parser.add_argument("--file-size", type=parse_size, default=parse_size("50M"))
+    parser.add_argument("--ext", default=".bin", help="extension of the resolved files")
+    parser.add_argument("--folder-files", type=int, default=0, help="make every share a folder of this many files")
+    parser.add_argument("--split-size", type=parse_size, help="override SPLIT_SIZE to exercise splitting")
+    parser.add_argument("--download-rate", type=parse_size, default=parse_size("50M"), help="bytes/s per download")
+    parser.add_argument("--aria2", choices=("fake", "real"), default="fake")
+    parser.add_argument("--primary", choices=("ok", "slow", "fail"), default="ok")
+    parser.add_argument("--alternate", choices=("ok", "slow", "fail"), default="ok")
+    parser.add_argument("--resolver-delay", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=3.0)
+    parser.add_argument("--resolver-port", type=int, default=8765)
+    parser.add_argument("--sessions", type=int, default=1, help="upload sessions, the bot included")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--upload-rate", type=parse_size, default=parse_size("20M"), help="bytes/s per upload")
+    parser.add_argument("--floodwait-rate", type=float, default=0.0, help="chance of FloodWait per call")
+    parser.add_argument("--floodwait-seconds", type=int, default=3)
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for terabox.py")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's INFO logs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="terabox-bench-")
+    args.download_dir = os.path.join(workdir, "downloads")
+    os.makedirs(args.download_dir)
+    base_url = f"http://127.0.0.1:{args.resolver_port}/api"
+    os.environ.update({
+        "TELEGRAM_API": "1", "TELEGRAM_HASH": "bench", "BOT_TOKEN": "1:bench",
+        "DUMP_CHAT_ID": "-1001", "FSUB_ID": "-1002",
+        "TERABOX_API_URL": f"{base_url}/primary", "ALTERNATE_API_URL": f"{base_url}/alternate",
+        "DB_PATH": os.path.join(workdir, "bench.db"), "DOWNLOAD_DIR": args.download_dir,
+        # The fake Telegram implements the high-level send methods, not raw MTProto
+        "UPLOAD_WORKERS": "0",
+    })
+    if args.folder_files:
+        os.environ["TERABOX_LIST_API_URL"] = f"http://127.0.0.1:{args.resolver_port}/list"
+    os.environ.update(dict(item.split("=", 1) for item in args.env))
+
+    stand_ins = multiprocessing.Process(target=serve_stand_ins, args=(args,), daemon=True)
+    stand_ins.start()
+    aria2c = None
+    if args.aria2 == "real":
+        aria2c = subprocess.Popen([
+            "aria2c", "--enable-rpc", f"--rpc-listen-port={ARIA2_PORT}", f"--dir={args.download_dir}",
+            "--max-concurrent-downloads=10", "--max-connection-per-server=10", "--split=10",
+            "--min-split-size=4M", "--allow-overwrite=true", "--quiet=true",
+        ])
+    time.sleep(1.5)
+
+    try:
+        # aria2 must already be listening: terabox.py configures it at import time
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        import terabox as tb
+        if not args.verbose:
+            logging.getLogger("terabox").setLevel(logging.WARNING)
+        if args.split_size:
+            tb.SPLIT_SIZE = args.split_size
+        asyncio.run(run_benchmark(args, tb))
+    finally:
+        if aria2c:
+            aria2c.terminate()
+        stand_ins.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,41 @@
-from aria2p import API as Aria2API, Client as Aria2Client
+from aria2p import API as Aria2API, Client as Aria2Client, Download as Aria2Download
 import asyncio
 from dotenv import load_dotenv
 from datetime import datetime
 import os
+import io
+import glob
+import signal
 import logging
 import math
-from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
-from pyrogram.enums import ChatMemberStatus
-from pyrogram.errors import FloodWait
+import bisect
+import shutil
+import shlex
+import re
+import struct
+from pyrogram import Client, filters, raw, utils
+from pyrogram.session import Session
+from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaVideo
+from pyrogram.enums import ChatMemberStatus, MessageEntityType
+from pyrogram.errors import FloodWait, MessageNotModified
 import time
+import json
+from collections import deque
+import sqlite3
 import urllib.parse
 from urllib.parse import urlparse
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 from threading import Thread
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 import aiohttp
+import socket
+import uuid
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import ReturnDocument
+except ImportError:
+    AsyncIOMotorClient = None
 
 load_dotenv('config.env', override=True)
 logging.basicConfig(
@@ -28,6 +49,97 @@ logging.getLogger("pyrogram.session").setLevel(logging.ERROR)
 logging.getLogger("pyrogram.connection").setLevel(logging.ERROR)
 logging.getLogger("pyrogram.dispatcher").setLevel(logging.ERROR)
 
+# Prometheus-style metrics. Everything is recorded on the bot's event loop, so
+# recording is a plain dict/list update with no locks; the Flask thread only
+# reads snapshots when /metrics is scraped.
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in list(self.values.items()):
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        # labels -> per-bucket counts (last one is +Inf), then sum and count
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0, 0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in list(self.values.items()):
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-1]}")
+        return lines
+
+class Gauge:
+    """Read at scrape time from a callback returning {labels tuple: value}"""
+
+    def __init__(self, name, help_text, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            for key, value in self.collect().items():
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        except Exception as e:
+            logger.error(f"Failed to collect {self.name}: {e}")
+        return lines
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in key) + "}"
+
+SECONDS_BUCKETS = [0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+SPEED_BUCKETS = [256 * 1024 * 2 ** i for i in range(12)]  # 256 KiB/s .. 512 MiB/s
+
+resolve_seconds = Histogram("terabox_resolve_seconds", "Resolver request latency", SECONDS_BUCKETS)
+resolve_total = Counter("terabox_resolve_total", "Resolver requests by outcome")
+download_seconds = Histogram("terabox_download_seconds", "Time to download a file with aria2", SECONDS_BUCKETS)
+download_speed = Histogram("terabox_download_speed_bytes", "Average aria2 speed of a download", SPEED_BUCKETS)
+downloads_total = Counter("terabox_downloads_total", "Finished downloads by outcome")
+split_seconds = Histogram("terabox_split_seconds", "Time to split a file into parts", SECONDS_BUCKETS)
+upload_seconds = Histogram("terabox_upload_seconds", "Time to upload a file or part", SECONDS_BUCKETS)
+upload_speed = Histogram("terabox_upload_speed_bytes", "Throughput of one file or part upload", SPEED_BUCKETS)
+upload_bytes_total = Counter("terabox_upload_bytes_total", "Bytes uploaded to Telegram")
+floodwait_seconds_total = Counter("terabox_floodwait_seconds_total", "Seconds of FloodWait received from Telegram")
+metrics = [
+    resolve_seconds, resolve_total, download_seconds, download_speed, downloads_total,
+    split_seconds, upload_seconds, upload_speed, upload_bytes_total, floodwait_seconds_total,
+]
+
 # Improved Aria2 configuration with more robust settings
 aria2 = Aria2API(
     Aria2Client(
@@ -42,7 +154,9 @@ options = {
     "continue": "true",
     "allow-overwrite": "true",
     "min-split-size": "4M",
-    "split": "10",
+    # Downloads added with get_download_options pick their own split and connections
+    "split": "8",
+    "max-connection-per-server": "8",
     "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "check-certificate": "false",
     "follow-metalink": "true",
@@ -52,6 +166,404 @@ options = {
 
 aria2.set_global_options(options)
 
+# aria2 saves unfinished downloads here, GIDs included, and reloads them on start
+# (see start.sh), so journaled jobs can reattach to them after a restart
+ARIA2_SESSION_FILE = 'aria2.session'
+
+class Aria2RPCError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+# Non-blocking aria2 JSON-RPC client. Calls go over a pooled aiohttp session and
+# download events are pushed over the aria2 WebSocket, so the poller wakes up as
+# soon as a download finishes instead of on the next tick.
+class Aria2RPC:
+    NOTIFICATIONS = (
+        "aria2.onDownloadComplete",
+        "aria2.onDownloadError",
+        "aria2.onDownloadStop",
+        "aria2.onBtDownloadComplete",
+    )
+
+    def __init__(self, url, secret=""):
+        self.url = url
+        self.ws_url = url.replace("http", "ws", 1)
+        self.token = f"token:{secret}" if secret else None
+        self.session = None
+        self.listener = None
+        self.notified = asyncio.Event()
+        self.request_id = 0
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20),
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+        return self.session
+
+    def with_token(self, params):
+        return [self.token, *params] if self.token else list(params)
+
+    async def call(self, method, *params):
+        session = await self.get_session()
+        self.request_id += 1
+        payload = {
+            "jsonrpc": "2.0",
+            "id": str(self.request_id),
+            "method": method,
+            # system.* methods carry the token inside each nested call instead
+            "params": list(params) if method.startswith("system.") else self.with_token(params),
+        }
+        async with session.post(self.url, json=payload) as response:
+            data = await response.json(content_type=None)
+        if "error" in data:
+            raise Aria2RPCError(data["error"].get("message"), data["error"].get("code"))
+        return data["result"]
+
+    async def multicall(self, calls):
+        methods = [
+            {"methodName": method, "params": self.with_token(params)}
+            for method, *params in calls
+        ]
+        results = await self.call("system.multicall", methods)
+        return [
+            result[0] if isinstance(result, list) else Aria2RPCError(result.get("message"), result.get("code"))
+            for result in results
+        ]
+
+    async def add_uris(self, uris, options=None):
+        gid = await self.call("aria2.addUri", uris, options or {})
+        return await self.tell_status(gid)
+
+    # Submit several downloads in one round trip; failed entries come back as Aria2RPCError
+    async def add_uris_batch(self, batch):
+        gids = await self.multicall([("aria2.addUri", uris, options or {}) for uris, options in batch])
+        added = [gid for gid in gids if not isinstance(gid, Exception)]
+        statuses = iter(await self.multicall([("aria2.tellStatus", gid) for gid in added]) if added else [])
+        results = []
+        for gid in gids:
+            if isinstance(gid, Exception):
+                results.append(gid)
+                continue
+            struct = next(statuses)
+            results.append(struct if isinstance(struct, Exception) else Aria2Download(aria2, struct))
+        return results
+
+    async def tell_status(self, gid):
+        struct = await self.call("aria2.tellStatus", gid)
+        return Aria2Download(aria2, struct)
+
+    async def remove(self, gid):
+        try:
+            await self.call("aria2.remove", gid)
+        except Aria2RPCError as e:
+            logger.warning(f"Failed to remove download {gid}: {e}")
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                    logger.info("Subscribed to aria2 download notifications")
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            continue
+                        if msg.json().get("method") in self.NOTIFICATIONS:
+                            self.notified.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"aria2 notifications unavailable, relying on polling: {e}")
+            await asyncio.sleep(5)
+
+aria2_rpc = Aria2RPC("http://localhost:6800/jsonrpc", secret="")
+
+# aria2 opens at most this many connections to one server
+ARIA2_MAX_CONNECTIONS = 16
+# Starting connections by file size: small files finish before extra connections
+# pay off; the tuner raises them later when a download turns out to be slow
+DOWNLOAD_CONNECTION_TIERS = [
+    (32 * 1024 * 1024, 2),
+    (256 * 1024 * 1024, 4),
+    (1024 * 1024 * 1024, 8),
+]
+
+def connections_for_size(size):
+    if not size:
+        return DOWNLOAD_CONNECTION_TIERS[-1][1]
+    for limit, connections in DOWNLOAD_CONNECTION_TIERS:
+        if size <= limit:
+            return connections
+    return ARIA2_MAX_CONNECTIONS
+
+# Per-download options; pieces are fetched in order when streaming uploads are on
+# Big non-video files are uploaded range by range while they download
+def can_stream_upload(size, file_name):
+    if not STREAM_UPLOAD or not VIRTUAL_SPLIT or not size or not file_name:
+        return False
+    return size > SPLIT_SIZE and os.path.splitext(file_name)[1].lower() not in VIDEO_EXTENSIONS
+
+def get_download_options(size=None, file_name=None):
+    connections = connections_for_size(size)
+    options = {
+        "dir": DOWNLOAD_DIR,
+        "split": str(connections),
+        "max-connection-per-server": str(connections),
+    }
+    # In-order pieces only pay off for downloads that will be streamed
+    if can_stream_upload(size, file_name):
+        options["stream-piece-selector"] = "inorder"
+    return options
+
+# Bytes available from the start of the file, from the aria2 piece bitfield
+def get_contiguous_length(download):
+    bitfield = download.bitfield
+    if not bitfield:
+        return 0
+    pieces = 0
+    for char in bitfield:
+        value = int(char, 16)
+        if value == 0xF:
+            pieces += 4
+            continue
+        for bit in (8, 4, 2, 1):
+            if not value & bit:
+                break
+            pieces += 1
+        break
+    return min(pieces * download.piece_length, download.total_length)
+
+# Single poller for every active download: one system.multicall per tick no matter
+# how many jobs are running, fanned out to the jobs subscribed to each gid
+class DownloadPoller:
+    STATUS_KEYS = [
+        "gid", "status", "totalLength", "completedLength", "downloadSpeed",
+        "connections", "dir", "files", "errorCode", "errorMessage",
+        "bitfield", "pieceLength", "numPieces",
+    ]
+
+    def __init__(self, rpc, interval=3, stall_window=30, tuner=None):
+        self.rpc = rpc
+        self.tuner = tuner
+        self.interval = interval
+        self.stall_window = stall_window
+        self.statuses = {}
+        self.history = {}
+        self.subscribers = {}
+        self.global_stat = {}
+        self.task = None
+
+    def subscribe(self, gid):
+        self.subscribers[gid] = asyncio.Event()
+        self.history[gid] = deque()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def unsubscribe(self, gid):
+        self.subscribers.pop(gid, None)
+        self.statuses.pop(gid, None)
+        self.history.pop(gid, None)
+
+    async def next_status(self, gid):
+        event = self.subscribers.get(gid)
+        if event is None:
+            return None
+        await event.wait()
+        event.clear()
+        struct = self.statuses.get(gid)
+        return Aria2Download(aria2, struct) if struct else None
+
+    def is_stalled(self, gid):
+        # Stalled when no bytes arrived and speed stayed at zero for the whole window
+        samples = self.history.get(gid)
+        if not samples or samples[-1][0] - samples[0][0] < self.stall_window:
+            return False
+        return samples[-1][1] == samples[0][1] and all(speed == 0 for _, _, speed in samples)
+
+    def average_speed(self, gid):
+        samples = self.history.get(gid)
+        if not samples:
+            return 0
+        return sum(speed for _, _, speed in samples) / len(samples)
+
+    async def poll(self):
+        results = await self.rpc.multicall([
+            ("aria2.tellActive", self.STATUS_KEYS),
+            ("aria2.tellWaiting", 0, 1000, self.STATUS_KEYS),
+            ("aria2.tellStopped", 0, 1000, self.STATUS_KEYS),
+            ("aria2.getGlobalStat",),
+        ])
+        *lists, global_stat = results
+        if not isinstance(global_stat, Exception):
+            self.global_stat = global_stat
+        seen = {}
+        for result in lists:
+            if isinstance(result, Exception):
+                raise result
+            for struct in result:
+                seen[struct["gid"]] = struct
+        now = time.time()
+        for gid, event in list(self.subscribers.items()):
+            struct = seen.get(gid)
+            self.statuses[gid] = struct
+            samples = self.history[gid]
+            # Only active downloads can stall; one queued or paused by aria2
+            # starts a fresh window once it runs
+            if not struct or struct["status"] != "active":
+                samples.clear()
+            else:
+                samples.append((now, int(struct["completedLength"]), int(struct["downloadSpeed"])))
+                # Keep one sample at or past the window so a full window can be judged
+                while len(samples) > 1 and now - samples[1][0] >= self.stall_window:
+                    samples.popleft()
+            event.set()
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                await self.poll()
+                if self.tuner:
+                    await self.tuner.update([
+                        struct for gid, struct in self.statuses.items()
+                        if gid in self.subscribers and struct and struct["status"] == "active"
+                    ])
+            except Exception as e:
+                logger.error(f"Error polling aria2: {e}")
+            try:
+                await asyncio.wait_for(self.rpc.notified.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.rpc.notified.clear()
+
+# Total download rate shared by all active downloads, 0 for no limit
+DOWNLOAD_BANDWIDTH_LIMIT = int(float(os.environ.get('DOWNLOAD_BANDWIDTH_LIMIT_MB', 0)) * 1024 * 1024)
+# Seconds each connection setting is measured before the next decision
+TUNE_PROBE_SECONDS = 15
+# A download must have this much time left to be worth reconnecting for
+TUNE_MIN_REMAINING_SECONDS = 60
+# Gain more connections have to bring to be kept
+TUNE_MIN_GAIN = 1.15
+# Floor of any download's share of the bandwidth budget
+MIN_DOWNLOAD_LIMIT = 256 * 1024
+
+class TunedDownload:
+    def __init__(self, connections, completed, now):
+        self.connections = connections
+        self.previous_connections = None
+        self.baseline = None
+        self.settled = False
+        self.limit = 0
+        self.phase_started = now
+        self.phase_completed = completed
+
+# Adjusts active downloads from the poller's statuses: each one measures its
+# starting connection count, then tries doubling it while that pays off
+# (aria2 reconnects in place and keeps the downloaded pieces). With a
+# bandwidth budget, active downloads get max-min fair shares of it, so a big
+# download can't starve small ones.
+class DownloadTuner:
+    def __init__(self, rpc, bandwidth_limit=0):
+        self.rpc = rpc
+        self.bandwidth_limit = bandwidth_limit
+        self.downloads = {}
+
+    async def change(self, gid, **options):
+        try:
+            await self.rpc.call("aria2.changeOption", gid, {key.replace("_", "-"): str(value) for key, value in options.items()})
+            return True
+        except Aria2RPCError as e:
+            logger.warning(f"Could not change options of download {gid}: {e}")
+            return False
+
+    async def set_connections(self, gid, tuned, connections):
+        if not await self.change(gid, split=connections, max_connection_per_server=connections):
+            return False
+        tuned.previous_connections = tuned.connections
+        tuned.connections = connections
+        return True
+
+    async def probe(self, struct, tuned, now):
+        completed = int(struct["completedLength"])
+        elapsed = now - tuned.phase_started
+        if tuned.settled or elapsed < TUNE_PROBE_SECONDS:
+            return
+        speed = (completed - tuned.phase_completed) / elapsed
+        tuned.phase_started = now
+        tuned.phase_completed = completed
+        gid = struct["gid"]
+
+        if tuned.baseline is not None and speed < tuned.baseline * TUNE_MIN_GAIN:
+            # More connections didn't help, go back and stop probing
+            logger.info(f"Download {gid}: {tuned.connections} connections gave no gain, back to {tuned.previous_connections}")
+            await self.set_connections(gid, tuned, tuned.previous_connections)
+            tuned.settled = True
+            return
+        tuned.baseline = speed
+
+        remaining = int(struct["totalLength"]) - completed
+        capped = tuned.limit and speed >= tuned.limit * 0.9
+        if (tuned.connections >= ARIA2_MAX_CONNECTIONS or capped or speed <= 0
+                or remaining < speed * TUNE_MIN_REMAINING_SECONDS):
+            tuned.settled = True
+            return
+        connections = min(ARIA2_MAX_CONNECTIONS, tuned.connections * 2)
+        logger.info(f"Download {gid}: trying {connections} connections (now {format_size(speed)}/s)")
+        if not await self.set_connections(gid, tuned, connections):
+            tuned.settled = True
+
+    async def share_bandwidth(self, active):
+        # New downloads want everything, the rest want some headroom over
+        # their current speed so a download held at its share can grow
+        demands = {}
+        for struct in active:
+            tuned = self.downloads[struct["gid"]]
+            if tuned.limit:
+                demands[struct["gid"]] = int(struct["downloadSpeed"]) * 1.25
+            else:
+                demands[struct["gid"]] = self.bandwidth_limit
+        shares = {}
+        remaining = self.bandwidth_limit
+        pending = sorted(demands, key=demands.get)
+        while pending:
+            fair = remaining / len(pending)
+            gid = pending[0]
+            if demands[gid] >= fair:
+                shares.update((gid, fair) for gid in pending)
+                break
+            shares[gid] = demands[gid]
+            remaining -= demands[gid]
+            pending.pop(0)
+        for gid, share in shares.items():
+            tuned = self.downloads[gid]
+            limit = int(max(MIN_DOWNLOAD_LIMIT, share))
+            if tuned.limit and abs(limit - tuned.limit) < tuned.limit * 0.1:
+                continue
+            if await self.change(gid, max_download_limit=limit):
+                tuned.limit = limit
+
+    async def update(self, active):
+        now = time.time()
+        for gid in set(self.downloads) - {struct["gid"] for struct in active}:
+            del self.downloads[gid]
+        for struct in active:
+            tuned = self.downloads.get(struct["gid"])
+            if tuned is None:
+                try:
+                    connections = int((await self.rpc.call("aria2.getOption", struct["gid"]))["split"])
+                except (Aria2RPCError, KeyError, ValueError):
+                    connections = connections_for_size(int(struct["totalLength"]))
+                self.downloads[struct["gid"]] = TunedDownload(connections, int(struct["completedLength"]), now)
+                continue
+            await self.probe(struct, tuned, now)
+        if self.bandwidth_limit and active:
+            await self.share_bandwidth(active)
+
+download_tuner = DownloadTuner(aria2_rpc, DOWNLOAD_BANDWIDTH_LIMIT)
+download_poller = DownloadPoller(aria2_rpc, tuner=download_tuner)
+
 API_ID = os.environ.get('TELEGRAM_API', '')
 if len(API_ID) == 0:
     logging.error("TELEGRAM_API variable is missing! Exiting now")
@@ -90,10 +602,46 @@ if len(USER_SESSION_STRING) == 0:
 TERABOX_API_URL = os.environ.get('TERABOX_API_URL', 'https://teradlrobot.cheemsbackup.workers.dev/')
 ALTERNATE_API_URL = os.environ.get('ALTERNATE_API_URL', 'https://tboxapi.fly.dev/api/')
 
-app = Client("jetbot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Any number of resolver endpoints, comma separated; defaults to the two above
+RESOLVER_URLS = [
+    api_url.strip() for api_url in os.environ.get('RESOLVER_URLS', '').split(',') if api_url.strip()
+] or [TERABOX_API_URL, ALTERNATE_API_URL]
+RESOLVER_HEDGE_DELAY = float(os.environ.get('RESOLVER_HEDGE_DELAY', 1.5))
+# Optional API listing the files of a share as JSON, used to expand folder shares
+TERABOX_LIST_API_URL = os.environ.get('TERABOX_LIST_API_URL', '')
+# Telegram albums hold at most this many files
+MEDIA_GROUP_SIZE = 10
+
+# Scale-out: an "ingress" process receives updates and queues jobs in DATABASE_URL,
+# "worker" processes run them on their own aria2 and disk; "standalone" does both
+BOT_ROLE = os.environ.get('BOT_ROLE', 'standalone').lower()
+if BOT_ROLE not in ('standalone', 'ingress', 'worker'):
+    logging.error(f"Unknown BOT_ROLE {BOT_ROLE}! Exiting now")
+    exit(1)
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+if BOT_ROLE != 'standalone' and not DATABASE_URL:
+    logging.error("DATABASE_URL is required when BOT_ROLE is ingress or worker! Exiting now")
+    exit(1)
+
+# Workers use the same bot token, but only the ingress receives updates
+app = Client(
+    "jetbot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+    no_updates=BOT_ROLE == 'worker', in_memory=BOT_ROLE == 'worker'
+)
 
 user = None
 SPLIT_SIZE = 2093796556
+# Upload non-video split parts as byte ranges of the original file instead of writing part files
+VIRTUAL_SPLIT = os.environ.get('VIRTUAL_SPLIT', 'true').lower() == 'true'
+# Video segments target this fraction of SPLIT_SIZE to leave room for bitrate spikes
+SEGMENT_HEADROOM = float(os.environ.get('SEGMENT_HEADROOM', 0.9))
+# Finished split parts allowed to wait on disk ahead of the uploader
+SPLIT_LOOKAHEAD = int(os.environ.get('SPLIT_LOOKAHEAD', 2))
+# Upload big non-video files range by range while aria2 is still downloading them
+STREAM_UPLOAD = os.environ.get('STREAM_UPLOAD', 'true').lower() == 'true'
+# Completed pieces may still sit in aria2's disk cache (16M by default), so a
+# range is only read once the contiguous prefix is this far past its end
+STREAM_SAFETY_MARGIN = 64 * 1024 * 1024
 if USER_SESSION_STRING:
     user = Client("jetu", api_id=API_ID, api_hash=API_HASH, session_string=USER_SESSION_STRING)
     SPLIT_SIZE = 4241280205
@@ -104,54 +652,1533 @@ VALID_DOMAINS = [
     'terabox.app', 'gibibox.com', 'goaibox.com', 'terasharelink.com', 
     'teraboxlink.com', 'terafileshare.com'
 ]
-last_update_time = 0
+# Host is one of VALID_DOMAINS or a subdomain of it
+VALID_DOMAIN_PATTERN = re.compile(
+    r"(?:^|\.)(?:" + "|".join(re.escape(domain) for domain in VALID_DOMAINS) + r")$", re.IGNORECASE
+)
+# Links in one message that are mirrored at the same time
+LINK_BATCH_PARALLELISM = int(os.environ.get('LINK_BATCH_PARALLELISM', 3))
+# Lines shown in a batch status message before the rest are summarized
+BATCH_STATUS_LINES = 20
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', '/downloads')
+VIDEO_EXTENSIONS = ['.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.mpg', '.mpeg', '.webm']
+
+# Persistent index of shares already mirrored to DUMP_CHAT_ID, so repeat links
+# can be served with copy_message instead of downloading them again
+DB_PATH = os.environ.get('DB_PATH', 'jetbot.db')
+
+class DedupIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS shares ("
+            "share_id TEXT PRIMARY KEY, file_name TEXT, file_size INTEGER, "
+            "part_count INTEGER, message_ids TEXT, created_at REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, share_id):
+        if not share_id:
+            return None
+        row = self.conn.execute(
+            "SELECT file_name, file_size, part_count, message_ids FROM shares WHERE share_id = ?",
+            (share_id,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "file_name": row[0],
+            "file_size": row[1],
+            "part_count": row[2],
+            "message_ids": json.loads(row[3]),
+        }
+
+    def add(self, share_id, file_name, file_size, message_ids):
+        if not share_id or not message_ids:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO shares VALUES (?, ?, ?, ?, ?, ?)",
+            (share_id, file_name, file_size, len(message_ids), json.dumps(message_ids), time.time())
+        )
+        self.conn.commit()
+
+    def evict(self, share_id):
+        self.conn.execute("DELETE FROM shares WHERE share_id = ?", (share_id,))
+        self.conn.commit()
+
+dedup_index = DedupIndex(DB_PATH)
+
+# Jobs in progress, kept next to the dedup index so a restart can pick each one
+# up from its last completed stage: the aria2 GID to reattach to, the finished
+# download to upload, and the parts (or folder files) already delivered
+JOURNAL_MAX_ATTEMPTS = 3
+
+class JobJournal:
+    COLUMNS = ("stage", "gid", "direct_url", "file_path", "delivered", "done_files", "attempts")
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "share_id TEXT PRIMARY KEY, url TEXT, chat_id INTEGER, message_id INTEGER, stage TEXT, "
+            "gid TEXT, direct_url TEXT, file_path TEXT, delivered TEXT, done_files TEXT, "
+            "attempts INTEGER, updated_at REAL)"
+        )
+        self.conn.commit()
+
+    def start(self, share_id, url, chat_id, message_id):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, 'resolve', NULL, NULL, NULL, '[]', '[]', 0, ?)",
+            (share_id, url, chat_id, message_id, time.time())
+        )
+        self.conn.commit()
+
+    def update(self, share_id, **fields):
+        for name in fields:
+            if name not in self.COLUMNS:
+                raise ValueError(f"Unknown journal column {name}")
+        assignments = "".join(f"{name} = ?, " for name in fields)
+        self.conn.execute(
+            f"UPDATE jobs SET {assignments}updated_at = ? WHERE share_id = ?",
+            (*fields.values(), time.time(), share_id)
+        )
+        self.conn.commit()
+
+    def append(self, share_id, column, value):
+        if column not in ("delivered", "done_files"):
+            raise ValueError(f"Journal column {column} is not a list")
+        row = self.conn.execute(f"SELECT {column} FROM jobs WHERE share_id = ?", (share_id,)).fetchone()
+        if row:
+            self.update(share_id, **{column: json.dumps(json.loads(row[0]) + [value])})
+
+    def finish(self, share_id):
+        self.conn.execute("DELETE FROM jobs WHERE share_id = ?", (share_id,))
+        self.conn.commit()
+
+    def pending(self):
+        rows = self.conn.execute(
+            "SELECT share_id, url, chat_id, message_id, stage, gid, direct_url, file_path, "
+            "delivered, done_files, attempts FROM jobs ORDER BY updated_at"
+        ).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(zip(("share_id", "url", "chat_id", "message_id", "stage", "gid", "direct_url",
+                            "file_path", "delivered", "done_files", "attempts"), row))
+            job["delivered"] = json.loads(job["delivered"])
+            job["done_files"] = json.loads(job["done_files"])
+            jobs.append(job)
+        return jobs
+
+    def get(self, share_id):
+        return next((job for job in self.pending() if job["share_id"] == share_id), None)
+
+    def file_paths(self):
+        return [row[0] for row in self.conn.execute("SELECT file_path FROM jobs WHERE file_path IS NOT NULL")]
+
+job_journal = JobJournal(DB_PATH)
+
+# Shared queue between the ingress and the workers. A job is a plain dict:
+# the request (share_id, url, chat/message ids, where the status message is),
+# its lease (state, owner node, run, lease_until, attempts) and what the worker
+# reports back (status_text, final, delivered, done_files, file_name, file_size).
+# Workers hold a job only while they keep renewing its lease; an expired lease
+# lets another worker claim it.
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 60))
+JOB_HEARTBEAT_INTERVAL = 5
+JOB_POLL_INTERVAL = 2
+JOB_MAX_ATTEMPTS = 3
+# Jobs one worker runs at once; its stage schedulers still bound each stage
+WORKER_JOBS = int(os.environ.get('WORKER_JOBS', 4))
+WORKER_ID = os.environ.get('WORKER_ID') or socket.gethostname()
+# Tells this process apart from earlier runs of the same worker node
+RUN_ID = uuid.uuid4().hex
+
+class MongoJobStore:
+    def __init__(self, url):
+        if AsyncIOMotorClient is None:
+            raise RuntimeError("DATABASE_URL points to MongoDB but motor is not installed")
+        self.jobs = AsyncIOMotorClient(url).get_default_database("jetbot").jobs
+
+    async def enqueue(self, job):
+        await self.jobs.insert_one({**job, "_id": job["job_id"]})
+
+    async def claim(self, worker_id, run_id, lease, reclaim=False):
+        now = time.time()
+        if reclaim:
+            # Jobs this node held before it restarted
+            query = {"state": "running", "owner": worker_id, "run": {"$ne": run_id}}
+        else:
+            query = {"$or": [{"state": "queued"}, {"state": "running", "lease_until": {"$lt": now}}]}
+        query["attempts"] = {"$lt": JOB_MAX_ATTEMPTS}
+        return await self.jobs.find_one_and_update(
+            query,
+            {
+                "$set": {"state": "running", "owner": worker_id, "run": run_id,
+                         "lease_until": now + lease, "updated_at": now},
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def heartbeat(self, job_id, run_id, lease, **fields):
+        now = time.time()
+        result = await self.jobs.update_one(
+            {"_id": job_id, "state": "running", "run": run_id},
+            {"$set": {**fields, "lease_until": now + lease, "updated_at": now}}
+        )
+        return result.matched_count == 1
+
+    async def complete(self, job_id, run_id, **fields):
+        await self.jobs.update_one(
+            {"_id": job_id, "run": run_id},
+            {"$set": {**fields, "final": True, "updated_at": time.time()}}
+        )
+
+    async def fail_abandoned(self, text):
+        await self.jobs.update_many(
+            {"state": "running", "lease_until": {"$lt": time.time()}, "attempts": {"$gte": JOB_MAX_ATTEMPTS}},
+            {"$set": {"state": "failed", "final": True, "status_text": text, "updated_at": time.time()}}
+        )
+
+    async def list_jobs(self):
+        return await self.jobs.find().to_list(None)
+
+    async def remove(self, job_id):
+        await self.jobs.delete_one({"_id": job_id})
+
+class SQLiteJobStore:
+    """Stand-in for the shared queue, for development and tests: processes on one
+    host share it through a SQLite file (DATABASE_URL=sqlite:///path)"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS queued_jobs ("
+            "job_id TEXT PRIMARY KEY, state TEXT, owner TEXT, run TEXT, lease_until REAL, "
+            "attempts INTEGER, created_at REAL, doc TEXT)"
+        )
+
+    def save(self, job):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO queued_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job["job_id"], job["state"], job.get("owner"), job.get("run"), job.get("lease_until"),
+             job["attempts"], job["created_at"], json.dumps(job))
+        )
+
+    def select(self, where, params=()):
+        rows = self.conn.execute(f"SELECT doc FROM queued_jobs WHERE {where} ORDER BY created_at", params)
+        return [json.loads(row[0]) for row in rows.fetchall()]
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    async def enqueue(self, job):
+        async with self.transaction():
+            self.save(job)
+
+    async def claim(self, worker_id, run_id, lease, reclaim=False):
+        now = time.time()
+        async with self.transaction():
+            if reclaim:
+                jobs = self.select("state = 'running' AND owner = ? AND run != ? AND attempts < ?",
+                                   (worker_id, run_id, JOB_MAX_ATTEMPTS))
+            else:
+                jobs = self.select("(state = 'queued' OR (state = 'running' AND lease_until < ?)) AND attempts < ?",
+                                   (now, JOB_MAX_ATTEMPTS))
+            if not jobs:
+                return None
+            job = jobs[0]
+            job.update(state="running", owner=worker_id, run=run_id, lease_until=now + lease,
+                       attempts=job["attempts"] + 1, updated_at=now)
+            self.save(job)
+        return job
+
+    async def heartbeat(self, job_id, run_id, lease, **fields):
+        now = time.time()
+        async with self.transaction():
+            jobs = self.select("job_id = ? AND state = 'running' AND run = ?", (job_id, run_id))
+            if not jobs:
+                return False
+            jobs[0].update(fields, lease_until=now + lease, updated_at=now)
+            self.save(jobs[0])
+        return True
+
+    async def complete(self, job_id, run_id, **fields):
+        async with self.transaction():
+            for job in self.select("job_id = ? AND run = ?", (job_id, run_id)):
+                job.update(fields, final=True, updated_at=time.time())
+                self.save(job)
+
+    async def fail_abandoned(self, text):
+        async with self.transaction():
+            for job in self.select("state = 'running' AND lease_until < ? AND attempts >= ?",
+                                   (time.time(), JOB_MAX_ATTEMPTS)):
+                job.update(state="failed", final=True, status_text=text, updated_at=time.time())
+                self.save(job)
+
+    async def list_jobs(self):
+        return self.select("1")
+
+    async def remove(self, job_id):
+        async with self.transaction():
+            self.conn.execute("DELETE FROM queued_jobs WHERE job_id = ?", (job_id,))
+
+def open_job_store(url):
+    if url.startswith(("mongodb://", "mongodb+srv://")):
+        return MongoJobStore(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteJobStore(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported DATABASE_URL scheme: {url.split(':', 1)[0]}")
+
+job_store = open_job_store(DATABASE_URL) if BOT_ROLE != 'standalone' else None
+
+# Shares currently going through the pipeline; concurrent requesters subscribe
+# to the owner's job and get each part copied as soon as it lands in the dump chat
+class InflightShare:
+    def __init__(self):
+        self.message_ids = []
+        self.done = False
+        self.failed = False
+        self.changed = asyncio.Condition()
+
+    async def add_part(self, msg_id):
+        async with self.changed:
+            self.message_ids.append(msg_id)
+            self.changed.notify_all()
+
+    async def finish(self):
+        async with self.changed:
+            if not self.message_ids:
+                self.failed = True
+            self.done = True
+            self.changed.notify_all()
+
+    async def follow(self):
+        index = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: index < len(self.message_ids) or self.done)
+                new_ids = self.message_ids[index:]
+                done = self.done
+            for msg_id in new_ids:
+                yield msg_id
+            index += len(new_ids)
+            if done and index >= len(self.message_ids):
+                return
+
+inflight_shares = {}
+
+# Admission control in front of the pipeline. Every stage has its own concurrency
+# limit; waiting jobs are served round-robin across users and, optionally,
+# shortest-job-first within a user's queue once the size is known.
+class StageTicket:
+    def __init__(self, user_id, size, seq):
+        self.user_id = user_id
+        self.size = size
+        self.seq = seq
+        self.granted = asyncio.get_running_loop().create_future()
+
+class StageScheduler:
+    def __init__(self, name, limit, shortest_first=False):
+        self.name = name
+        self.limit = limit
+        self.shortest_first = shortest_first
+        self.active = 0
+        self.queues = OrderedDict()
+        self.seq = 0
+
+    @property
+    def waiting(self):
+        return sum(len(tickets) for tickets in self.queues.values())
+
+    def order_key(self, ticket):
+        if self.shortest_first:
+            return (ticket.size is None, ticket.size or 0, ticket.seq)
+        return (ticket.seq,)
+
+    def dispatch(self):
+        while self.active < self.limit and self.queues:
+            user_id, tickets = next(iter(self.queues.items()))
+            ticket = min(tickets, key=self.order_key)
+            tickets.remove(ticket)
+            if tickets:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            self.active += 1
+            ticket.granted.set_result(True)
+
+    def position(self, ticket):
+        # Replay the round-robin order to find how many jobs are served first
+        queues = [sorted(tickets, key=self.order_key) for tickets in self.queues.values()]
+        position = 0
+        while queues:
+            tickets = queues.pop(0)
+            position += 1
+            if tickets.pop(0) is ticket:
+                return position
+            if tickets:
+                queues.append(tickets)
+        return position
+
+    @asynccontextmanager
+    async def slot(self, user_id, status_message=None, size=None):
+        self.seq += 1
+        ticket = StageTicket(user_id, size, self.seq)
+        self.queues.setdefault(user_id, []).append(ticket)
+        self.dispatch()
+        try:
+            last_position = None
+            while not ticket.granted.done():
+                position = self.position(ticket)
+                if status_message and position != last_position:
+                    update_status_message(
+                        status_message,
+                        f"⏳ Queued for {self.name}: position {position} of {self.waiting}"
+                    )
+                    last_position = position
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.granted), 10)
+                except asyncio.TimeoutError:
+                    pass
+            yield
+        finally:
+            if ticket.granted.done():
+                self.active -= 1
+            else:
+                ticket.granted.cancel()
+                tickets = self.queues.get(user_id, [])
+                if ticket in tickets:
+                    tickets.remove(ticket)
+                if not tickets:
+                    self.queues.pop(user_id, None)
+            self.dispatch()
+
+SHORTEST_JOB_FIRST = os.environ.get('SHORTEST_JOB_FIRST', 'false').lower() == 'true'
+resolve_stage = StageScheduler("resolve", int(os.environ.get('RESOLVE_CONCURRENCY', 8)))
+download_stage = StageScheduler("download", int(os.environ.get('DOWNLOAD_CONCURRENCY', 4)))
+split_stage = StageScheduler("split", int(os.environ.get('SPLIT_CONCURRENCY', 1)), SHORTEST_JOB_FIRST)
+
+# Non-premium accounts cannot upload files bigger than this
+NON_PREMIUM_UPLOAD_LIMIT = 2000 * 1024 * 1024
+# Extra user sessions that share the upload load, comma separated
+EXTRA_SESSION_STRINGS = [
+    session.strip() for session in os.environ.get('EXTRA_SESSION_STRINGS', '').split(',') if session.strip()
+]
+
+# Connections per upload session that push the chunks of one big file in
+# parallel; 0 or 1 keeps pyrogram's own single-connection upload
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+# Largest chunk Telegram accepts, and the size above which files must use SaveBigFilePart
+UPLOAD_CHUNK_SIZE = 512 * 1024
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+class UploadSession:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.active = 0
+        # Set from FloodWait errors; the session gets no work until then
+        self.unavailable_until = 0
+        # Media DC connections shared by all big uploads on this session
+        self.media_sessions = []
+        self.media_lock = asyncio.Lock()
+
+    @property
+    def is_premium(self):
+        return bool(self.client.me and self.client.me.is_premium)
+
+    def can_carry(self, size):
+        return size <= NON_PREMIUM_UPLOAD_LIMIT or self.is_premium
+
+    async def get_media_sessions(self):
+        async with self.media_lock:
+            if not self.media_sessions:
+                storage = self.client.storage
+                dc_id, auth_key, test_mode = await storage.dc_id(), await storage.auth_key(), await storage.test_mode()
+                for _ in range(UPLOAD_WORKERS):
+                    session = Session(self.client, dc_id, auth_key, test_mode, is_media=True)
+                    await session.start()
+                    self.media_sessions.append(session)
+            return self.media_sessions
+
+    async def save_big_file(self, path, progress=None):
+        """Upload a path or FilePart with SaveBigFilePart over every media connection at once"""
+        if isinstance(path, FilePart):
+            fd, base, file_size, name = path.fd, path.offset, path.length, path.name
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            base, file_size, name = 0, os.fstat(fd).st_size, os.path.basename(path)
+        file_id = self.client.rnd_id()
+        total_parts = math.ceil(file_size / UPLOAD_CHUNK_SIZE)
+        next_part = 0
+        uploaded = 0
+        loop = asyncio.get_running_loop()
+
+        # Each worker holds at most one chunk, so memory stays at workers * chunk size
+        async def worker(session):
+            nonlocal next_part, uploaded
+            while next_part < total_parts:
+                part = next_part
+                next_part += 1
+                chunk = await loop.run_in_executor(
+                    None, os.pread, fd, UPLOAD_CHUNK_SIZE, base + part * UPLOAD_CHUNK_SIZE
+                )
+                for attempt in range(5):
+                    try:
+                        await session.invoke(raw.functions.upload.SaveBigFilePart(
+                            file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=chunk
+                        ))
+                        break
+                    except FloodWait:
+                        raise
+                    except Exception as e:
+                        if attempt == 4:
+                            raise
+                        logger.warning(f"Chunk {part} of {name} failed on {self.name}, retrying: {e}")
+                        await asyncio.sleep(attempt + 1)
+                uploaded += len(chunk)
+                if progress:
+                    await progress(uploaded, file_size)
+
+        workers = [asyncio.create_task(worker(session)) for session in await self.get_media_sessions()]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if not isinstance(path, FilePart):
+                os.close(fd)
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=name)
+
+    async def send_big_file(self, kind, path, caption="", progress=None, duration=0, width=0, height=0,
+                            thumb=None, supports_streaming=True):
+        client = self.client
+        file = await self.save_big_file(path, progress)
+        attributes = [raw.types.DocumentAttributeFilename(file_name=file.name)]
+        if kind == "video":
+            attributes.insert(0, raw.types.DocumentAttributeVideo(
+                duration=duration, w=width, h=height, supports_streaming=supports_streaming
+            ))
+        media = raw.types.InputMediaUploadedDocument(
+            mime_type=client.guess_mime_type(file.name) or ("video/mp4" if kind == "video" else "application/zip"),
+            file=file,
+            thumb=await client.save_file(thumb) if thumb else None,
+            attributes=attributes
+        )
+        r = await client.invoke(raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(DUMP_CHAT_ID),
+            media=media,
+            random_id=client.rnd_id(),
+            **await utils.parse_text_entities(client, caption, None, None)
+        ))
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await Message._parse(
+                    client, update.message, {u.id: u for u in r.users}, {c.id: c for c in r.chats}
+                )
+
+class UploadPool:
+    """Spreads uploads to the dump chat over the bot and every user session"""
+
+    def __init__(self):
+        self.sessions = []
+
+    def add(self, client, name):
+        self.sessions.append(UploadSession(client, name))
+
+    @property
+    def parallelism(self):
+        return max(1, len(self.sessions))
+
+    async def start(self):
+        # The bot itself is started by app.run(); start the user sessions on the same loop
+        for session in self.sessions:
+            if session.client is app:
+                continue
+            try:
+                await session.client.start()
+                logger.info(f"Upload session {session.name} started (premium: {session.is_premium})")
+            except Exception as e:
+                logger.error(f"Failed to start upload session {session.name}: {e}")
+
+    async def acquire(self, size):
+        while True:
+            candidates = [s for s in self.sessions if s.client.is_connected and s.can_carry(size)]
+            if not candidates:
+                raise RuntimeError(f"No connected session can upload {format_size(size)}")
+            now = time.time()
+            ready = [s for s in candidates if s.unavailable_until <= now]
+            if ready:
+                return min(ready, key=lambda s: s.active)
+            # Every capable session is flood-limited; wait for the first one to recover
+            await asyncio.sleep(min(s.unavailable_until for s in candidates) - now)
+
+    async def upload(self, kind, path, size, **kwargs):
+        while True:
+            session = await self.acquire(size)
+            session.active += 1
+            started = time.monotonic()
+            try:
+                if kind == "album":
+                    sent = await session.client.send_media_group(DUMP_CHAT_ID, path)
+                elif UPLOAD_WORKERS > 1 and size > BIG_FILE_THRESHOLD:
+                    sent = await session.send_big_file(kind, path, **kwargs)
+                else:
+                    send = session.client.send_video if kind == "video" else session.client.send_document
+                    sent = await send(DUMP_CHAT_ID, path, **kwargs)
+                elapsed = time.monotonic() - started
+                # Albums are routed by their largest file but carry all of them
+                sent_bytes = sum(get_part_size(media.media) for media in path) if kind == "album" else size
+                upload_seconds.observe(elapsed, session=session.name)
+                upload_speed.observe(sent_bytes / elapsed if elapsed > 0 else 0, session=session.name)
+                upload_bytes_total.inc(sent_bytes, session=session.name)
+                return sent
+            except FloodWait as e:
+                logger.warning(f"FloodWait on upload session {session.name}: backing off {e.value}s")
+                floodwait_seconds_total.inc(e.value, source="upload")
+                session.unavailable_until = time.time() + e.value
+                if isinstance(path, io.IOBase):
+                    path.seek(0)
+                elif kind == "album":
+                    for media in path:
+                        if isinstance(media.media, io.IOBase):
+                            media.media.seek(0)
+            finally:
+                session.active -= 1
+
+upload_pool = UploadPool()
+upload_pool.add(app, "bot")
+if user:
+    upload_pool.add(user, "user")
+for i, session_string in enumerate(EXTRA_SESSION_STRINGS):
+    upload_pool.add(
+        Client(f"jetu{i + 2}", api_id=API_ID, api_hash=API_HASH, session_string=session_string,
+               in_memory=True, no_updates=True),
+        f"extra{i + 1}"
+    )
+
+upload_stage = StageScheduler(
+    "upload", int(os.environ.get('UPLOAD_CONCURRENCY', 2 * upload_pool.parallelism)), SHORTEST_JOB_FIRST
+)
+
+# Space kept free on the download volume on top of every job's reservation
+DISK_HEADROOM = int(os.environ.get('DISK_HEADROOM_MB', 1024)) * 1024 * 1024
+# How often the janitor sweeps DOWNLOAD_DIR, and how long a file must sit
+# untouched before an unowned one counts as orphaned
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 600))
+JANITOR_GRACE = 300
+
+class InsufficientDiskSpace(Exception):
+    pass
+
+# A job's files: everything inside its directory, or its download and the
+# .aria2 / .partNNN / .NNN.ext files next to it
+def owns_path(owner, path):
+    if not owner:
+        return False
+    if os.path.isdir(owner):
+        return path.startswith(owner.rstrip(os.sep) + os.sep)
+    return path == owner or path.startswith(os.path.splitext(owner)[0] + ".")
+
+# Peak bytes a job may hold: the download, plus the split parts that can sit
+# next to it (the splitter keeps at most SPLIT_LOOKAHEAD finished parts and
+# the one it is writing). Unknown names are assumed to need real part files.
+def estimate_disk_need(size, file_name=None):
+    if size <= SPLIT_SIZE:
+        return size
+    # Without a name, assume no part files; the reservation is resized once
+    # aria2 reports the real name
+    if VIRTUAL_SPLIT and (not file_name or os.path.splitext(file_name)[1].lower() not in VIDEO_EXTENSIONS):
+        return size
+    return size + min(size, (SPLIT_LOOKAHEAD + 1) * SPLIT_SIZE)
+
+class DiskReservation:
+    def __init__(self, budget):
+        self.budget = budget
+        self.expected = 0
+        # Bytes of the reservation already written to disk by aria2
+        self.downloaded = 0
+        # Download path, so the janitor leaves the file and its parts alone
+        self.path = None
+
+    @property
+    def outstanding(self):
+        return max(0, self.expected - self.downloaded)
+
+    async def admit(self, expected, status_message=None):
+        await self.budget.admit(self, expected, status_message)
+
+    def resize(self, expected):
+        self.expected = expected
+        self.budget.changed()
+
+    def release(self, size):
+        self.expected = max(0, self.expected - size)
+        self.downloaded = min(self.downloaded, self.expected)
+        self.budget.changed()
+
+    def owns(self, path):
+        return owns_path(self.path, path)
+
+    def close(self):
+        self.budget.reservations.discard(self)
+        self.budget.changed()
+
+class DiskBudget:
+    """Admits jobs in arrival order once their expected bytes fit on the
+    download volume, counting what running jobs have reserved but not yet written"""
 
-# Function to check download URL before adding to aria2
+    def __init__(self, path, headroom):
+        self.path = path
+        self.headroom = headroom
+        self.reservations = set()
+        self.waiting = deque()
+        self.event = asyncio.Event()
+
+    def open(self):
+        reservation = DiskReservation(self)
+        self.reservations.add(reservation)
+        return reservation
+
+    def available(self):
+        free = shutil.disk_usage(self.path).free
+        return free - self.headroom - sum(r.outstanding for r in self.reservations)
+
+    def changed(self):
+        self.event.set()
+        self.event.clear()
+
+    async def admit(self, reservation, expected, status_message=None):
+        self.waiting.append(reservation)
+        announced = False
+        try:
+            while self.waiting[0] is not reservation or self.available() < expected:
+                running = [r for r in self.reservations if r is not reservation and r not in self.waiting]
+                if self.waiting[0] is reservation and not running:
+                    # No running job will give space back, waiting can't help
+                    raise InsufficientDiskSpace(
+                        f"Not enough disk space: need {format_size(expected)}, "
+                        f"{format_size(max(0, self.available()))} free"
+                    )
+                if status_message and not announced:
+                    update_status_message(status_message, f"💾 Waiting for disk space ({format_size(expected)} needed)")
+                    announced = True
+                try:
+                    # Space is also freed outside the bot, so re-check now and then
+                    await asyncio.wait_for(self.event.wait(), 10)
+                except asyncio.TimeoutError:
+                    pass
+            reservation.expected = expected
+        finally:
+            self.waiting.remove(reservation)
+            self.changed()
+
+    def owns(self, path):
+        return any(reservation.owns(path) for reservation in self.reservations)
+
+disk_budget = DiskBudget(DOWNLOAD_DIR, DISK_HEADROOM)
+
+# Remove files in DOWNLOAD_DIR that no job and no unfinished aria2 download owns:
+# downloads orphaned by crashes and .partNNN / .NNN.ext split leftovers
+async def sweep_download_dir():
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return
+    owned = set()
+    try:
+        results = await aria2_rpc.multicall([
+            ("aria2.tellActive", ["files"]),
+            ("aria2.tellWaiting", 0, 1000, ["files"]),
+        ])
+    except Exception as e:
+        logger.warning(f"Janitor could not list aria2 downloads, skipping sweep: {e}")
+        return
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Janitor could not list aria2 downloads, skipping sweep: {result}")
+            return
+        for status in result:
+            for file in status.get("files", []):
+                if file.get("path"):
+                    owned.add(os.path.realpath(file["path"]))
+    protected = {os.path.realpath(DB_PATH + suffix) for suffix in ("", "-journal", "-wal", "-shm")}
+    protected.add(os.path.realpath(ARIA2_SESSION_FILE))
+    # Jobs waiting to be resumed after a restart
+    journaled = job_journal.file_paths()
+    now = time.time()
+    removed = 0
+    freed = 0
+    for root, dirs, files in os.walk(DOWNLOAD_DIR, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            real_path = os.path.realpath(path)
+            # aria2 keeps its control file next to the download as <file>.aria2
+            download_path = real_path[:-len(".aria2")] if real_path.endswith(".aria2") else real_path
+            if download_path in owned or real_path in protected or disk_budget.owns(path):
+                continue
+            if any(owns_path(owner, path) for owner in journaled):
+                continue
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime < JANITOR_GRACE:
+                    continue
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+            except OSError as e:
+                logger.warning(f"Janitor could not remove {path}: {e}")
+        if root != DOWNLOAD_DIR and not os.listdir(root):
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+    if removed:
+        logger.info(f"Janitor removed {removed} orphaned files from {DOWNLOAD_DIR} ({format_size(freed)})")
+        disk_budget.changed()
+
+async def run_janitor():
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        try:
+            await sweep_download_dir()
+        except Exception as e:
+            logger.error(f"Janitor sweep failed: {e}")
+
+# Long-lived pooled HTTP session shared by the resolver and the startup checks,
+# so repeat calls reuse keep-alive connections and cached DNS lookups
+http_session = None
+
+async def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return http_session
+
+# Expiry timestamp carried by a direct link (expires=<epoch> or time=<epoch>&expires=8h)
+def get_link_expiry(url):
+    query = urllib.parse.parse_qs(urlparse(url).query)
+    expires = (query.get('expires') or query.get('x-expires') or [''])[0]
+    if expires.isdigit() and int(expires) > 1000000000:
+        return int(expires)
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    issued = (query.get('time') or [''])[0]
+    if issued.isdigit() and expires[:-1].isdigit() and expires[-1:] in units:
+        return int(issued) + int(expires[:-1]) * units[expires[-1]]
+    return None
+
+# Share URL -> resolved ShareFile (direct URL, size and name), honouring the link's own expiry
+class ResolveCache:
+    def __init__(self, ttl, max_entries=2048, expiry_margin=300):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        link, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return link
+
+    def set(self, key, link, link_expiry=None):
+        expires_at = time.time() + self.ttl
+        if link_expiry:
+            expires_at = min(expires_at, link_expiry - self.expiry_margin)
+        if expires_at <= time.time():
+            return
+        self.entries[key] = (link, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+resolve_cache = ResolveCache(int(os.environ.get('RESOLVE_CACHE_TTL', 3600)))
+
+# Function to check download URL before adding to aria2. Returns the URL the
+# resolver redirected to, so aria2 downloads it directly and its expiry applies,
+# with the size and file name (Content-Disposition or URL path) for reserving
+# disk space.
 async def check_download_url(url):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.head(url, allow_redirects=True, timeout=10) as response:
-                if response.status == 200:
-                    return True, url
-                else:
-                    return False, None
+        session = await get_http_session()
+        async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            if response.status == 200:
+                direct_url = str(response.url)
+                disposition = response.content_disposition
+                file_name = disposition.filename if disposition and disposition.filename else None
+                if not file_name:
+                    file_name = os.path.basename(response.url.path) or None
+                link = ShareFile(file_name, direct_url, response.content_length)
+                return True, link, get_link_expiry(direct_url)
+            else:
+                return False, None, None
     except Exception as e:
         logger.error(f"Error checking URL {url}: {e}")
-        return False, None
+        return False, None, None
+
+# Resolver endpoints are raced: the best-scored one goes first and the next is
+# hedged after RESOLVER_HEDGE_DELAY (or as soon as a request fails). Each endpoint
+# keeps rolling latency/success scores and a circuit breaker.
+class ResolverEndpoint:
+    ALPHA = 0.2
+    BREAKER_THRESHOLD = 3
+    BREAKER_COOLDOWN = 60
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.latency = None
+        self.success_rate = 1.0
+        self.consecutive_failures = 0
+        self.open_until = 0
+
+    @property
+    def available(self):
+        return time.time() >= self.open_until
+
+    @property
+    def score(self):
+        # Expected time to a good answer; lower is better
+        return (self.latency or 1.0) / max(self.success_rate, 0.05)
+
+    def record_latency(self, latency):
+        self.latency = latency if self.latency is None else (1 - self.ALPHA) * self.latency + self.ALPHA * latency
 
-# Function to get direct download URL from terabox link
+    def record(self, ok, latency):
+        self.success_rate = (1 - self.ALPHA) * self.success_rate + self.ALPHA * (1 if ok else 0)
+        if ok:
+            self.record_latency(latency)
+            self.consecutive_failures = 0
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.BREAKER_THRESHOLD:
+            self.open_until = time.time() + self.BREAKER_COOLDOWN
+            logger.warning(f"Resolver {self.base_url} keeps failing, skipping it for {self.BREAKER_COOLDOWN}s")
+
+resolver_endpoints = [ResolverEndpoint(base_url) for base_url in RESOLVER_URLS]
+
+async def probe_resolver(endpoint, encoded_url):
+    started = time.monotonic()
+    try:
+        valid, link, expiry = await check_download_url(f"{endpoint.base_url}?url={encoded_url}")
+    except asyncio.CancelledError:
+        # Lost the race: the time spent is only a lower bound on its latency,
+        # so it can raise the average but never lower it
+        elapsed = time.monotonic() - started
+        if elapsed > (endpoint.latency or 1.0):
+            endpoint.record_latency(elapsed)
+        resolve_total.inc(endpoint=endpoint.base_url, result="cancelled")
+        raise
+    latency = time.monotonic() - started
+    endpoint.record(valid, latency)
+    resolve_seconds.observe(latency, endpoint=endpoint.base_url)
+    resolve_total.inc(endpoint=endpoint.base_url, result="ok" if valid else "failed")
+    return valid, link, expiry
+
+# Function to get direct download URL from terabox link, as a ShareFile
 async def get_terabox_direct_link(url):
-    # Try primary API first
+    share_id = get_share_id(url)
+    cached_link = resolve_cache.get(share_id)
+    if cached_link:
+        return cached_link
+
     encoded_url = urllib.parse.quote(url)
-    primary_url = f"{TERABOX_API_URL}?url={encoded_url}"
-    
-    valid, checked_url = await check_download_url(primary_url)
-    if valid:
-        return checked_url
-    
-    # If primary fails, try alternate API
-    alternate_url = f"{ALTERNATE_API_URL}?url={encoded_url}"
-    valid, checked_url = await check_download_url(alternate_url)
-    if valid:
-        return checked_url
-    
-    # If both fail, return primary URL as fallback
-    return primary_url
+    # Endpoints with an open breaker are only tried when nothing else is left
+    endpoints = [endpoint for endpoint in resolver_endpoints if endpoint.available] or resolver_endpoints
+    endpoints = sorted(endpoints, key=lambda endpoint: endpoint.score)
+    pending = set()
+    result = None
+    try:
+        for endpoint in endpoints:
+            pending.add(asyncio.create_task(probe_resolver(endpoint, encoded_url)))
+            done, pending = await asyncio.wait(pending, timeout=RESOLVER_HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED)
+            result = next((task.result() for task in done if task.result()[0]), None)
+            if result:
+                break
+        while not result and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            result = next((task.result() for task in done if task.result()[0]), None)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if result:
+        _, link, expiry = result
+        resolve_cache.set(share_id, link, expiry)
+        return link
+
+    # If every resolver fails, return primary URL as fallback
+    return ShareFile(None, f"{RESOLVER_URLS[0]}?url={encoded_url}")
+
+class ShareFile:
+    def __init__(self, name, url, size=None):
+        self.name = name
+        self.url = url
+        self.size = size
+
+# Accepts the listing shapes common Terabox APIs return: a list of entries, or a
+# dict holding one under "files", "list" or "data"
+def parse_share_listing(data):
+    if isinstance(data, dict):
+        data = next((data[key] for key in ("files", "list", "data") if isinstance(data.get(key), list)), [])
+    if not isinstance(data, list):
+        return []
+    files = []
+    for entry in data:
+        if not isinstance(entry, dict) or entry.get("isdir") in (1, "1", True):
+            continue
+        link = next((entry[key] for key in ("direct_link", "download_link", "dlink", "link", "url") if entry.get(key)), None)
+        name = next((entry[key] for key in ("file_name", "server_filename", "filename", "name") if entry.get(key)), None)
+        if not link or not name:
+            continue
+        try:
+            size = int(entry.get("size") or entry.get("sizebytes"))
+        except (TypeError, ValueError):
+            size = None
+        files.append(ShareFile(os.path.basename(name), link, size))
+    return files
+
+# Files of a share from TERABOX_LIST_API_URL; empty when it isn't configured or fails
+async def list_share_files(url):
+    if not TERABOX_LIST_API_URL:
+        return []
+    try:
+        session = await get_http_session()
+        list_url = f"{TERABOX_LIST_API_URL}?url={urllib.parse.quote(url)}"
+        async with session.get(list_url, timeout=aiohttp.ClientTimeout(total=20)) as response:
+            if response.status != 200:
+                logger.warning(f"Listing {url} returned status {response.status}")
+                return []
+            return parse_share_listing(await response.json(content_type=None))
+    except Exception as e:
+        logger.warning(f"Could not list files of {url}: {e}")
+        return []
+
+# Fresh direct link once the old one expired mid-download: the share is resolved
+# again past the cache, and a folder file is looked up in a new listing
+async def refresh_direct_link(url, share_file=None):
+    if share_file is None:
+        resolve_cache.invalidate(get_share_id(url))
+        return (await get_terabox_direct_link(url)).url
+    for f in await list_share_files(url):
+        if f.name == share_file.name and (not share_file.size or f.size == share_file.size):
+            return f.url
+    return None
+
+MEMBER_STATUSES = [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
+
+# Force-subscribe results per user, so steady traffic needs no get_chat_member
+# call; join/leave updates from FSUB_ID overwrite entries right away
+class MembershipCache:
+    def __init__(self, member_ttl, non_member_ttl, max_entries=10000):
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if not entry:
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return is_member
+
+    def set(self, user_id, is_member):
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        self.entries[user_id] = (is_member, time.time() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+membership_cache = MembershipCache(
+    int(os.environ.get('MEMBER_CACHE_TTL', 3600)),
+    int(os.environ.get('NON_MEMBER_CACHE_TTL', 60)),
+)
 
 async def is_user_member(client, user_id):
+    cached = membership_cache.get(user_id)
+    if cached is not None:
+        return cached
     try:
         member = await client.get_chat_member(FSUB_ID, user_id)
-        if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            return True
-        else:
-            return False
+        is_member = member.status in MEMBER_STATUSES
+        membership_cache.set(user_id, is_member)
+        return is_member
     except Exception as e:
         logging.error(f"Error checking membership status for user {user_id}: {e}")
         return False
     
 def is_valid_url(url):
+    try:
+        host = urlparse(url).hostname
+    except ValueError:
+        return False
+    return bool(host and VALID_DOMAIN_PATTERN.search(host))
+
+# Every Terabox link in a message, text or caption, including hidden text links,
+# in order and with repeats of the same share dropped
+def extract_links(message):
+    text = message.text or message.caption or ""
+    entities = message.entities or message.caption_entities or []
+    # Entity offsets count UTF-16 code units
+    encoded = text.encode('utf-16-le')
+    candidates = []
+    for entity in entities:
+        if entity.type == MessageEntityType.TEXT_LINK:
+            candidates.append(entity.url)
+        elif entity.type == MessageEntityType.URL:
+            candidates.append(encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le'))
+    candidates.extend(text.split())
+
+    links = []
+    seen = set()
+    for candidate in candidates:
+        candidate = candidate.strip('<>()[]"\',.')
+        if candidate and '://' not in candidate:
+            candidate = f"https://{candidate}"
+        if not is_valid_url(candidate):
+            continue
+        share_id = get_share_id(candidate)
+        if share_id in seen:
+            continue
+        seen.add(share_id)
+        links.append(candidate)
+    return links
+
+# Canonical share id of a Terabox link: /s/1AbCd and ?surl=AbCd map to the same share
+def get_share_id(url):
     parsed_url = urlparse(url)
-    return any(parsed_url.netloc.endswith(domain) for domain in VALID_DOMAINS)
+    query = urllib.parse.parse_qs(parsed_url.query)
+    if query.get('surl'):
+        return query['surl'][0]
+    path_parts = [part for part in parsed_url.path.split('/') if part]
+    if len(path_parts) >= 2 and path_parts[-2] == 's':
+        share = path_parts[-1]
+        return share[1:] if share.startswith('1') else share
+    return f"{parsed_url.netloc}{parsed_url.path}" or None
+
+# FloodWaits waited out while serving one cached share before giving up
+CACHED_COPY_FLOODWAITS = 5
+
+class CachedCopyError(Exception):
+    pass
+
+# Serve a share from the dump chat. Returns False when it has to be mirrored
+# again: the stored parts are gone (the entry is evicted) or none could be sent.
+# FloodWaits are waited out and copying resumes at the first part not sent yet;
+# a failure after some parts went out raises CachedCopyError instead, so the
+# user doesn't get those parts twice from a new mirror.
+async def send_cached_parts(client, message, share_id, cached):
+    message_ids = cached["message_ids"]
+    checked = False
+    copied = 0
+    floodwaits = 0
+    while True:
+        try:
+            if not checked:
+                stored = await client.get_messages(DUMP_CHAT_ID, message_ids)
+                if not isinstance(stored, list):
+                    stored = [stored]
+                if any(msg is None or msg.empty for msg in stored):
+                    logger.warning(f"Cached share {share_id} has deleted dump messages, evicting")
+                    dedup_index.evict(share_id)
+                    return False
+                checked = True
+            while copied < len(message_ids):
+                await client.copy_message(
+                    message.chat.id, DUMP_CHAT_ID, message_ids[copied],
+                    caption=caption_for_requester(stored[copied].caption, message)
+                )
+                copied += 1
+            return True
+        except FloodWait as e:
+            floodwaits += 1
+            if floodwaits > CACHED_COPY_FLOODWAITS:
+                error = e
+            else:
+                logger.warning(f"FloodWait serving cached share {share_id}: waiting {e.value}s")
+                floodwait_seconds_total.inc(e.value, source="dedup")
+                await asyncio.sleep(e.value)
+                continue
+        except Exception as e:
+            error = e
+        logger.error(f"Failed to serve cached share {share_id} after {copied}/{len(message_ids)} parts: {error}")
+        if copied:
+            raise CachedCopyError(f"{copied} of {len(message_ids)} parts sent")
+        return False
+
+# Byte range of a file exposed as a read-only file object, so a split part can be
+# uploaded straight from the original file without writing a part file
+class FilePart(io.RawIOBase):
+    def __init__(self, path, offset, length, name):
+        super().__init__()
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.name = name
+        self.position = 0
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.length - self.position)
+        if count <= 0:
+            return 0
+        data = os.pread(self.fd, count, self.offset + self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+# Copy a byte range into a new file inside the kernel, in bounded chunks, so
+# splitting never holds a part in Python memory
+def write_file_part(input_path, output_path, offset, length, chunk_size=64 * 1024 * 1024):
+    with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+        copied = 0
+        while copied < length:
+            count = min(chunk_size, length - copied)
+            try:
+                written = os.copy_file_range(src.fileno(), dst.fileno(), count, offset + copied)
+            except (AttributeError, OSError):
+                try:
+                    written = os.sendfile(dst.fileno(), src.fileno(), offset + copied, count)
+                except OSError:
+                    written = dst.write(os.pread(src.fileno(), min(count, 8 * 1024 * 1024), offset + copied))
+            if written == 0:
+                break
+            copied += written
+    return copied
+
+class MediaInfo:
+    def __init__(self, duration=None, width=None, height=None):
+        self.duration = duration
+        self.width = width
+        self.height = height
+
+# Containers whose index (moov) can sit after the media data
+FASTSTART_EXTENSIONS = ['.mp4', '.m4v', '.mov']
+# One ffprobe pass per file version, shared by the splitter and the uploader
+media_info_cache = OrderedDict()
+
+async def probe_media(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    info = media_info_cache.get(key)
+    if info:
+        return info
+    proc = await asyncio.create_subprocess_exec(
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type,width,height',
+        '-of', 'json', path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed on {os.path.basename(path)}: {stderr.decode().strip()[:200]}")
+    data = json.loads(stdout.decode() or '{}')
+    duration = data.get('format', {}).get('duration')
+    video = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), {})
+    info = MediaInfo(
+        float(duration) if duration not in (None, 'N/A') else None,
+        video.get('width'),
+        video.get('height')
+    )
+    media_info_cache[key] = info
+    while len(media_info_cache) > 256:
+        media_info_cache.popitem(last=False)
+    return info
+
+async def probe_duration(path):
+    info = await probe_media(path)
+    if info.duration is None:
+        raise ValueError(f"No duration for {os.path.basename(path)}")
+    return info.duration
+
+# Walk the top-level MP4 boxes: an index after the media data means players
+# have to fetch the end of the file before they can start
+def needs_faststart(path):
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        file_size = os.fstat(fd).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            header = os.pread(fd, 16, offset)
+            box_size, box_type = struct.unpack('>I4s', header[:8])
+            if box_size == 1 and len(header) == 16:
+                box_size = struct.unpack('>Q', header[8:])[0]
+            elif box_size == 0:
+                box_size = file_size - offset
+            if box_type == b'moov':
+                return False
+            if box_type == b'mdat':
+                return True
+            if box_size < 8:
+                return False
+            offset += box_size
+    return False
+
+# Stream-copy remux that moves the index to the front; the original is kept if it fails
+async def remux_faststart(path):
+    temp_path = f"{path}.faststart{os.path.splitext(path)[1]}"
+    info = await probe_media(path)
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'error', '-y', '-i', path, '-c', 'copy', '-map', '0',
+        '-movflags', '+faststart', temp_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise RuntimeError(f"faststart remux failed: {stderr.decode().strip()[:200]}")
+    os.replace(temp_path, path)
+    stat = os.stat(path)
+    media_info_cache[(path, stat.st_size, stat.st_mtime_ns)] = info
+
+# Telegram wants a JPEG of at most 320px for the preview
+async def make_thumbnail(path, duration=None):
+    thumb_path = f"{path}.thumb.jpg"
+    seek = min(duration * 0.1, 30) if duration else 0
+    proc = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-v', 'error', '-y', '-ss', f"{seek:.2f}", '-i', path,
+        '-frames:v', '1', '-vf', "scale='min(320,iw)':-2", '-q:v', '5', thumb_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    await proc.wait()
+    if proc.returncode == 0 and os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 0:
+        return thumb_path
+    if os.path.exists(thumb_path):
+        os.remove(thumb_path)
+    return None
+
+# Upload arguments for a video file or part: streamable layout, real duration and
+# dimensions and a thumbnail, so Telegram can show and stream it right away.
+# Falls back to no metadata when ffmpeg can't read the file.
+async def prepare_video_upload(path):
+    try:
+        if os.path.splitext(path)[1].lower() in FASTSTART_EXTENSIONS:
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, needs_faststart, path):
+                # The remux briefly needs a second copy of the file
+                if disk_budget.available() >= os.path.getsize(path):
+                    await remux_faststart(path)
+                else:
+                    logger.warning(f"Not enough disk space to remux {os.path.basename(path)} for streaming")
+        info = await probe_media(path)
+    except Exception as e:
+        logger.warning(f"Could not inspect {os.path.basename(path)}: {e}")
+        return {}
+    media = {"supports_streaming": True}
+    if info.duration:
+        media["duration"] = int(info.duration)
+    if info.width and info.height:
+        media["width"] = info.width
+        media["height"] = info.height
+    thumb = await make_thumbnail(path, info.duration)
+    if thumb:
+        media["thumb"] = thumb
+    return media
+
+def discard_thumbnail(media):
+    thumb = media.get("thumb") if media else None
+    if thumb and os.path.exists(thumb):
+        os.remove(thumb)
+
+# Segment a video in a single ffmpeg pass, cutting at the first keyframe after
+# every segment_time seconds. Returns the finished parts in order.
+async def segment_video(input_path, output_pattern, segment_time, on_segment=None, producer=None):
+    cmd_args = [
+        '-y', '-i', input_path,
+        '-c', 'copy', '-map', '0',
+        '-f', 'segment', '-segment_time', f"{segment_time:.3f}",
+        '-segment_start_number', '1',
+        '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+        '-reset_timestamps', '1', '-avoid_negative_ts', 'make_zero',
+        output_pattern
+    ]
+    if os.path.splitext(output_pattern)[1].lower() in FASTSTART_EXTENSIONS:
+        cmd_args[-1:-1] = ['-segment_format_options', 'movflags=+faststart']
+    output_dir = os.path.dirname(output_pattern)
+    # Try first with ffmpeg, then with xtra if available
+    for binary in ('ffmpeg', 'xtra'):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                binary, '-v', 'error', *cmd_args,
+                stdout=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError:
+            continue
+        if producer:
+            producer.proc = proc
+        split_files = []
+        try:
+            # ffmpeg prints each segment name once the segment is finalized
+            async for line in proc.stdout:
+                name = line.decode().strip()
+                if name:
+                    split_files.append(os.path.join(output_dir, os.path.basename(name)))
+                    if on_segment:
+                        await on_segment(split_files[-1])
+            returncode = await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        if returncode != 0:
+            if not on_segment:
+                for part in split_files:
+                    if os.path.exists(part):
+                        os.remove(part)
+            raise RuntimeError(f"{binary} exited with code {returncode}")
+        return split_files
+    raise FileNotFoundError("Neither ffmpeg nor xtra is available")
+
+# Split parts flow from the splitter to the uploader as soon as each one is
+# finalized. At most `lookahead` finished parts wait on disk: an ffmpeg producer
+# is paused with SIGSTOP, a file-copy producer simply waits for room.
+class PartProducer:
+    def __init__(self, lookahead):
+        self.lookahead = lookahead
+        self.total = 0
+        self.produced_count = 0
+        self.outstanding = 0
+        self.parts = asyncio.Queue()
+        self.room = asyncio.Event()
+        self.room.set()
+        self.proc = None
+        self.paused = False
+
+    def put(self, part):
+        self.produced_count += 1
+        self.total = max(self.total, self.produced_count)
+        self.outstanding += 1
+        self.parts.put_nowait(part)
+        if self.outstanding >= self.lookahead:
+            self.room.clear()
+            if self.proc and self.proc.returncode is None and not self.paused:
+                self.proc.send_signal(signal.SIGSTOP)
+                self.paused = True
+
+    def release(self):
+        self.outstanding -= 1
+        if self.outstanding < self.lookahead:
+            self.room.set()
+            if self.paused and self.proc and self.proc.returncode is None:
+                self.proc.send_signal(signal.SIGCONT)
+            self.paused = False
+
+    async def wait_for_room(self):
+        await self.room.wait()
+
+    def finish(self, error=None):
+        if self.paused and self.proc and self.proc.returncode is None:
+            self.proc.send_signal(signal.SIGCONT)
+        self.paused = False
+        self.parts.put_nowait(error or StopAsyncIteration())
+
+    def drain(self):
+        parts = []
+        while not self.parts.empty():
+            part = self.parts.get_nowait()
+            if not isinstance(part, BaseException):
+                parts.append(part)
+        return parts
+
+    async def __aiter__(self):
+        while True:
+            part = await self.parts.get()
+            if isinstance(part, StopAsyncIteration):
+                return
+            if isinstance(part, BaseException):
+                raise part
+            yield part
+
+# Re-cut the rare segment that still exceeds split_size (long GOPs or bitrate spikes)
+async def enforce_part_size(split_files, split_size, depth=0):
+    checked = []
+    for part in split_files:
+        part_size = os.path.getsize(part)
+        if part_size <= split_size:
+            checked.append(part)
+            continue
+        if depth >= 3:
+            raise RuntimeError(f"Could not cut {os.path.basename(part)} under {format_size(split_size)}")
+        logger.warning(f"Segment {os.path.basename(part)} is {format_size(part_size)}, cutting it again")
+        base, ext = os.path.splitext(part)
+        # Cuts land on the next keyframe, so aim lower on every retry
+        sub_time = await probe_duration(part) * SEGMENT_HEADROOM ** (depth + 2) * split_size / part_size
+        sub_parts = await segment_video(part, f"{base}-%02d{ext}", sub_time)
+        os.remove(part)
+        checked.extend(await enforce_part_size(sub_parts, split_size, depth + 1))
+    return checked
+
+def get_part_size(part):
+    return part.length if isinstance(part, FilePart) else os.path.getsize(part)
+
+def get_part_name(part):
+    return part.name if isinstance(part, FilePart) else os.path.basename(part)
+
+# Returns the bytes freed on disk
+def remove_part(part, file_path):
+    if isinstance(part, FilePart):
+        part.close()
+    elif os.path.exists(part) and part != file_path:
+        size = os.path.getsize(part)
+        os.remove(part)
+        return size
+    return 0
 
 def format_size(size):
     if size < 1024:
@@ -163,6 +2190,19 @@ def format_size(size):
     else:
         return f"{size / (1024 * 1024 * 1024):.2f} GB"
 
+# Needs the bot to be an admin of FSUB_ID to receive member updates
+@app.on_chat_member_updated()
+async def handle_fsub_member_update(client, update):
+    if not update.chat or str(update.chat.id) != str(FSUB_ID):
+        return
+    member = update.new_chat_member or update.old_chat_member
+    if not member or not member.user:
+        return
+    if update.new_chat_member:
+        membership_cache.set(member.user.id, update.new_chat_member.status in MEMBER_STATUSES)
+    else:
+        membership_cache.invalidate(member.user.id)
+
 @app.on_message(filters.command("start"))
 async def start_command(client: Client, message: Message):
     join_button = InlineKeyboardButton("ᴊᴏɪɴ ❤️🚀", url="https://t.me/jetmirror")
@@ -182,446 +2222,1368 @@ async def start_command(client: Client, message: Message):
     else:
         await message.reply_text(final_msg, reply_markup=reply_markup)
 
-async def update_status_message(status_message, text):
+# Seconds between progress edits of one message, between edits in one chat,
+# and the edits per second allowed across the whole bot
+STATUS_UPDATE_INTERVAL = 10
+STATUS_CHAT_INTERVAL = 3
+STATUS_GLOBAL_RATE = 20
+
+class StatusEditor:
+    """Single place that edits status messages. Callers only hand over the latest
+    text; edits are coalesced per message, paced per chat and globally, and
+    FloodWait pauses the chat here instead of inside a transfer"""
+
+    def __init__(self):
+        # (chat_id, message_id) -> (message, text, final), oldest first
+        self.pending = OrderedDict()
+        # (chat_id, message_id) -> (text, edited_at, final) of the last edit
+        self.sent = OrderedDict()
+        self.chat_ready = {}
+        self.global_ready = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def update(self, message, text, final=False):
+        key = (message.chat.id, message.id)
+        last = self.sent.get(key)
+        if last and last[2]:
+            return
+        queued = self.pending.get(key)
+        if queued and queued[2] and not final:
+            return
+        if last and last[0] == text:
+            self.pending.pop(key, None)
+            if final:
+                # Already on screen, but later progress edits must still be refused
+                self.sent[key] = (text, last[1], True)
+            return
+        self.pending[key] = (message, text, final)
+        self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def ready_at(self, key, final):
+        ready = max(self.chat_ready.get(key[0], 0), self.global_ready)
+        last = self.sent.get(key)
+        if last and not final:
+            ready = max(ready, last[1] + STATUS_UPDATE_INTERVAL)
+        return ready
+
+    async def run(self):
+        while self.pending:
+            self.wakeup.clear()
+            key, ready = min(
+                ((key, self.ready_at(key, final)) for key, (_, _, final) in self.pending.items()),
+                key=lambda item: item[1]
+            )
+            delay = ready - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            message, text, final = self.pending.pop(key)
+            await self.edit(key, message, text, final)
+
+    async def edit(self, key, message, text, final):
+        now = time.time()
+        self.chat_ready[key[0]] = now + STATUS_CHAT_INTERVAL
+        self.global_ready = now + 1 / STATUS_GLOBAL_RATE
+        try:
+            await message.edit_text(text)
+        except FloodWait as e:
+            logger.warning(f"FloodWait on status edits in chat {key[0]}: pausing it for {e.value}s")
+            floodwait_seconds_total.inc(e.value, source="status")
+            self.chat_ready[key[0]] = time.time() + e.value
+            # Retry later unless a newer text arrived meanwhile
+            if key not in self.pending:
+                self.pending[key] = (message, text, final)
+            return
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to update status message: {e}")
+        self.sent[key] = (text, time.time(), final)
+        self.sent.move_to_end(key)
+        while len(self.sent) > 1000:
+            self.sent.popitem(last=False)
+
+status_editor = StatusEditor()
+
+def update_status_message(status_message, text, final=False):
+    if isinstance(status_message, (BatchLine, RemoteStatus)):
+        status_message.set(text, final)
+        return
+    status_editor.update(status_message, text, final)
+
+# Stand-in status message for one link of a batch: the pipeline reports into it
+# like into its own message and the batch renders one line per link
+class BatchLine:
+    def __init__(self, batch, label):
+        self.batch = batch
+        self.label = label
+        self.text = "⏳ Waiting"
+        self.final = False
+
+    def set(self, text, final=False):
+        if self.final:
+            return
+        lines = [line.strip("┏┠┖ ") for line in text.splitlines() if line.strip()]
+        # Progress boxes are several lines, keep the one with the percentage
+        self.text = next((line for line in lines if '%' in line), lines[0] if lines else self.text)
+        self.final = final
+        self.batch.refresh()
+
+# Status of a job running on a worker: the latest text goes back to the shared
+# queue with each heartbeat and the ingress edits the real message
+class RemoteStatus:
+    def __init__(self):
+        self.text = ""
+        self.final = False
+
+    def set(self, text, final=False):
+        if self.final:
+            return
+        self.text = text
+        self.final = final
+
+class BatchStatus:
+    def __init__(self, status_message, share_ids):
+        self.status_message = status_message
+        self.lines = [BatchLine(self, share_id) for share_id in share_ids]
+
+    def render(self):
+        done = sum(1 for line in self.lines if line.final and line.text.startswith("✅"))
+        failed = sum(1 for line in self.lines if line.final and not line.text.startswith("✅"))
+        text = f"📦 {len(self.lines)} links: {done} done, {failed} failed\n"
+        for index, line in enumerate(self.lines[:BATCH_STATUS_LINES], 1):
+            text += f"\n{index}. {line.label}: {line.text}"
+        if len(self.lines) > BATCH_STATUS_LINES:
+            text += f"\n... and {len(self.lines) - BATCH_STATUS_LINES} more"
+        return text
+
+    def refresh(self):
+        final = all(line.final for line in self.lines)
+        update_status_message(self.status_message, self.render(), final=final)
+
+@app.on_message(filters.text | filters.caption)
+async def handle_message(client: Client, message: Message):
+    if (message.text or message.caption or "").startswith('/'):
+        return
+    if not message.from_user:
+        return
+
+    links = extract_links(message)
+    if not links and not message.text:
+        return
+
+    user_id = message.from_user.id
+    is_member = await is_user_member(client, user_id)
+
+    if not is_member:
+        join_button = InlineKeyboardButton("ᴊᴏɪɴ ❤️🚀", url="https://t.me/jetmirror")
+        reply_markup = InlineKeyboardMarkup([[join_button]])
+        await message.reply_text("ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴍʏ ᴄʜᴀɴɴᴇʟ ᴛᴏ ᴜsᴇ ᴍᴇ.", reply_markup=reply_markup)
+        return
+
+    if not links:
+        await message.reply_text("Please provide a valid Terabox link.")
+        return
+
+    if len(links) == 1:
+        await process_link(client, message, links[0])
+        return
+
+    # One status message for the whole batch, a few links mirrored at a time;
+    # the stage schedulers still bound the work across all users
+    share_ids = [get_share_id(url) for url in links]
+    status_message = await message.reply_text(f"📦 Found {len(links)} Terabox links, processing...")
+    batch = BatchStatus(status_message, share_ids)
+    batch.refresh()
+    semaphore = asyncio.Semaphore(LINK_BATCH_PARALLELISM)
+
+    async def run(url, line):
+        async with semaphore:
+            try:
+                await process_link(client, message, url, line)
+            except Exception as e:
+                logger.error(f"Batch link {url} failed: {e}")
+                line.set("⚠️ Failed. Please try again later.", final=True)
+
+    await asyncio.gather(*(run(url, line) for url, line in zip(links, batch.lines)))
+    logger.info(f"Batch of {len(links)} links for user {user_id} finished")
+
+async def process_link(client, message, url, status_message=None, resume=None):
+    # Serve repeat links straight from the dump chat
+    share_id = get_share_id(url)
+    cached = None if resume else dedup_index.get(share_id)
+    try:
+        served = cached and await send_cached_parts(client, message, share_id, cached)
+    except CachedCopyError:
+        text = "⚠️ Some parts failed to send. Please try again later."
+        if status_message:
+            update_status_message(status_message, text, final=True)
+        else:
+            await message.reply_text(text)
+        return
+    if served:
+        logger.info(f"Served share {share_id} from dump chat ({cached['part_count']} parts)")
+        if status_message:
+            update_status_message(status_message, "✅ Sent from the dump chat", final=True)
+        return
+
+    if BOT_ROLE == 'ingress':
+        job_id = remote_share_jobs.get(share_id)
+        if job_id:
+            await follow_remote_job(message, job_id, status_message)
+        else:
+            await enqueue_job(message, url, share_id, status_message)
+        return
+
+    # Coalesce concurrent requests for the same share onto one pipeline
+    inflight = inflight_shares.get(share_id)
+    if inflight:
+        await follow_inflight_share(client, message, share_id, inflight, status_message)
+        return
+
+    inflight = InflightShare()
+    if resume:
+        # Parts delivered before the restart still count for followers and the dedup index
+        inflight.message_ids.extend(resume["delivered"])
+    else:
+        job_journal.start(share_id, url, message.chat.id, message.id)
+    inflight_shares[share_id] = inflight
+    reservation = disk_budget.open()
+    interrupted = False
+    try:
+        await mirror_share(
+            client, message, url, share_id, inflight, reservation, status_message=status_message, resume=resume
+        )
+    except asyncio.CancelledError:
+        # Shutting down: keep the journal entry so the next start resumes the job
+        interrupted = True
+        raise
+    finally:
+        reservation.close()
+        del inflight_shares[share_id]
+        if not interrupted:
+            job_journal.finish(share_id)
+        await inflight.finish()
+
+# A download aria2 restored from its session file, if it can still be used
+async def find_resumable_download(gid):
+    try:
+        download = await aria2_rpc.tell_status(gid)
+        if download.status == "paused":
+            await aria2_rpc.call("aria2.unpause", gid)
+            download = await aria2_rpc.tell_status(gid)
+    except Aria2RPCError:
+        return None
+    if download.status in ("error", "removed"):
+        try:
+            await aria2_rpc.call("aria2.removeDownloadResult", gid)
+        except Aria2RPCError:
+            pass
+        return None
+    return download
+
+# Stop restored aria2 downloads inside a folder job's directory; the resumed job
+# adds them again and aria2 continues each file from its control file
+async def remove_downloads_under(path):
+    results = await aria2_rpc.multicall([
+        ("aria2.tellActive", ["gid", "files"]),
+        ("aria2.tellWaiting", 0, 1000, ["gid", "files"]),
+    ])
+    for result in results:
+        if isinstance(result, Exception):
+            continue
+        for status in result:
+            if any(owns_path(path, file.get("path", "")) for file in status.get("files", [])):
+                await aria2_rpc.remove(status["gid"])
+
+async def resume_job(job):
+    share_id = job["share_id"]
+    if job["attempts"] >= JOURNAL_MAX_ATTEMPTS:
+        logger.warning(f"Dropping job {share_id} after {job['attempts']} resume attempts")
+        job_journal.finish(share_id)
+        return
+    job_journal.update(share_id, attempts=job["attempts"] + 1)
+    if dedup_index.get(share_id):
+        # It finished right before the shutdown
+        job_journal.finish(share_id)
+        return
     try:
-        await status_message.edit_text(text)
+        message = await app.get_messages(job["chat_id"], job["message_id"])
     except Exception as e:
-        logger.error(f"Failed to update status message: {e}")
-
-@app.on_message(filters.text)
-async def handle_message(client: Client, message: Message):
-    if message.text.startswith('/'):
+        logger.error(f"Could not fetch the request of job {share_id}: {e}")
         return
-    if not message.from_user:
+    if not message or message.empty or not message.from_user:
+        logger.warning(f"Dropping job {share_id}: its request message is gone")
+        job_journal.finish(share_id)
         return
+    if job["stage"] == "folder" and job["file_path"]:
+        await remove_downloads_under(job["file_path"])
+    logger.info(f"Resuming job {share_id} from the {job['stage']} stage ({len(job['delivered'])} parts delivered)")
+    status_message = await message.reply_text("♻️ Resuming your link after a restart...")
+    await process_link(app, message, job["url"], status_message, resume=job)
 
-    user_id = message.from_user.id
-    is_member = await is_user_member(client, user_id)
+# Status messages of queued jobs, by job id, for the ingress to edit
+remote_status_targets = {}
+# Unfinished job per share, so repeat requests follow it instead of queueing
+# another download of the same file
+remote_share_jobs = {}
+remote_followers = {}
 
-    if not is_member:
-        join_button = InlineKeyboardButton("ᴊᴏɪɴ ❤️🚀", url="https://t.me/jetmirror")
-        reply_markup = InlineKeyboardMarkup([[join_button]])
-        await message.reply_text("ʏᴏᴜ ᴍᴜsᴛ ᴊᴏɪɴ ᴍʏ ᴄʜᴀɴɴᴇʟ ᴛᴏ ᴜsᴇ ᴍᴇ.", reply_markup=reply_markup)
+class RemoteFollower:
+    def __init__(self, message, status_message):
+        self.message = message
+        self.status_message = status_message
+        self.sent = 0
+
+async def follow_remote_job(message, job_id, status_message=None):
+    text = "⏳ This link is already being processed, you will get it as soon as it is ready..."
+    if status_message is None:
+        status_message = await message.reply_text(text)
+    else:
+        update_status_message(status_message, text)
+    remote_followers.setdefault(job_id, []).append(RemoteFollower(message, status_message))
+
+# Copy the parts a worker has delivered so far to one follower
+async def relay_parts(follower, delivered):
+    for msg_id in delivered[follower.sent:]:
+        stored = await app.get_messages(DUMP_CHAT_ID, msg_id)
+        await app.copy_message(
+            follower.message.chat.id, DUMP_CHAT_ID, msg_id,
+            caption=caption_for_requester(stored.caption, follower.message)
+        )
+        follower.sent += 1
+
+async def enqueue_job(message, url, share_id, status_message=None):
+    job_id = f"{message.chat.id}-{message.id}-{share_id}"
+    # Claimed before any await, so a concurrent request for the share follows this job
+    remote_share_jobs[share_id] = job_id
+    if status_message is None:
+        status_message = await message.reply_text("📥 Queued, waiting for a free worker...")
+    else:
+        update_status_message(status_message, "📥 Queued, waiting for a free worker...")
+    # Lines of a batch live in this process; a restarted ingress edits the batch message itself
+    target = status_message.batch.status_message if isinstance(status_message, BatchLine) else status_message
+    now = time.time()
+    remote_status_targets[job_id] = status_message
+    try:
+        await job_store.enqueue({
+            "job_id": job_id, "share_id": share_id, "url": url,
+            "chat_id": message.chat.id, "message_id": message.id,
+            "status_chat_id": target.chat.id, "status_message_id": target.id,
+            "state": "queued", "owner": None, "run": None, "lease_until": None, "attempts": 0,
+            "status_text": "", "final": False, "delivered": [], "done_files": [],
+            "file_name": None, "file_size": None, "created_at": now, "updated_at": now,
+        })
+    except Exception:
+        # Nothing was queued, so nobody can follow this job
+        remote_share_jobs.pop(share_id, None)
+        remote_status_targets.pop(job_id, None)
+        for follower in remote_followers.pop(job_id, []):
+            update_status_message(follower.status_message, "⚠️ Download failed. Please try again later.", final=True)
+        raise
+
+# Ingress side: render what the workers report and remember finished shares
+async def relay_jobs():
+    while not app.is_initialized:
+        await asyncio.sleep(1)
+    while True:
+        try:
+            await job_store.fail_abandoned("⚠️ Download failed. Please try again later.")
+            jobs = await job_store.list_jobs()
+        except Exception as e:
+            logger.error(f"Reading the job queue failed: {e}")
+            jobs = []
+        for job in jobs:
+            job_id = job["job_id"]
+            if not job["final"]:
+                remote_share_jobs.setdefault(job["share_id"], job_id)
+            try:
+                for follower in remote_followers.get(job_id, []):
+                    await relay_parts(follower, job["delivered"])
+                target = remote_status_targets.get(job_id)
+                if target is None:
+                    target = await app.get_messages(job["status_chat_id"], job["status_message_id"])
+                    remote_status_targets[job_id] = target
+                if job["status_text"]:
+                    update_status_message(target, job["status_text"], final=job["final"])
+                if job["final"]:
+                    if job["state"] == "done" and job["delivered"]:
+                        dedup_index.add(job["share_id"], job["file_name"], job["file_size"], job["delivered"])
+                    if remote_share_jobs.get(job["share_id"]) == job_id:
+                        del remote_share_jobs[job["share_id"]]
+                    for follower in remote_followers.pop(job_id, []):
+                        if follower.sent and job["state"] == "done":
+                            update_status_message(follower.status_message, "✅ Upload completed!", final=True)
+                        else:
+                            update_status_message(
+                                follower.status_message, "⚠️ Download failed. Please try again later.", final=True
+                            )
+                    await job_store.remove(job_id)
+                    remote_status_targets.pop(job_id, None)
+            except Exception as e:
+                logger.error(f"Relaying progress of job {job_id} failed: {e}")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+async def run_remote_job(job):
+    job_id = job["job_id"]
+    share_id = job["share_id"]
+    status = RemoteStatus()
+    job_task = asyncio.current_task()
+    lost_lease = False
+
+    async def heartbeat():
+        nonlocal lost_lease
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            # Delivered parts go along so another worker can skip them if this one dies
+            fields = {"status_text": status.text}
+            entry = job_journal.get(share_id)
+            if entry:
+                fields.update(delivered=entry["delivered"], done_files=entry["done_files"])
+            try:
+                if not await job_store.heartbeat(job_id, RUN_ID, JOB_LEASE, **fields):
+                    logger.warning(f"Lost the lease on job {job_id}, stopping it")
+                    lost_lease = True
+                    job_task.cancel()
+                    return
+            except Exception as e:
+                logger.warning(f"Heartbeat for job {job_id} failed: {e}")
+
+    logger.info(f"Worker {WORKER_ID} running job {job_id} (attempt {job['attempts']})")
+    beat = asyncio.create_task(heartbeat())
+    try:
+        message = await app.get_messages(job["chat_id"], job["message_id"])
+        if not message or message.empty or not message.from_user:
+            status.set("⚠️ The request message is gone.", final=True)
+        else:
+            # Local progress from before a restart wins; otherwise continue from
+            # what an earlier worker reported
+            resume = job_journal.get(share_id)
+            if resume is None and (job["delivered"] or job["done_files"]):
+                job_journal.start(share_id, job["url"], job["chat_id"], job["message_id"])
+                job_journal.update(share_id, delivered=json.dumps(job["delivered"]),
+                                   done_files=json.dumps(job["done_files"]))
+                resume = job_journal.get(share_id)
+            await process_link(app, message, job["url"], status, resume)
+    except asyncio.CancelledError:
+        if not lost_lease:
+            raise
+        # Another worker owns the job now
+        job_journal.finish(share_id)
         return
-    
-    url = None
-    for word in message.text.split():
-        if is_valid_url(word):
-            url = word
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {e}")
+        status.set("⚠️ Download failed. Please try again later.", final=True)
+    finally:
+        beat.cancel()
+
+    cached = dedup_index.get(share_id)
+    await job_store.complete(
+        job_id, RUN_ID,
+        state="done" if cached else "failed",
+        status_text=status.text or "⚠️ Download failed. Please try again later.",
+        delivered=cached["message_ids"] if cached else [],
+        file_name=cached["file_name"] if cached else None,
+        file_size=cached["file_size"] if cached else None,
+    )
+
+# Worker side: claim jobs from the shared queue while there is room for them
+async def run_worker():
+    while not app.is_initialized:
+        await asyncio.sleep(1)
+    running = set()
+
+    def start(job):
+        task = asyncio.create_task(run_remote_job(job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    # Jobs this node held before a restart come back first, with their local
+    # journal; journal entries for jobs other workers took over are dropped
+    reclaimed = []
+    while len(reclaimed) < WORKER_JOBS:
+        job = await job_store.claim(WORKER_ID, RUN_ID, JOB_LEASE, reclaim=True)
+        if not job:
             break
+        reclaimed.append(job)
+    kept = {job["share_id"] for job in reclaimed}
+    for entry in job_journal.pending():
+        if entry["share_id"] not in kept:
+            job_journal.finish(entry["share_id"])
+    for job in reclaimed:
+        start(job)
+    logger.info(f"Worker {WORKER_ID} taking jobs ({len(reclaimed)} resumed)")
 
-    if not url:
-        await message.reply_text("Please provide a valid Terabox link.")
-        return
+    while True:
+        try:
+            while len(running) < WORKER_JOBS:
+                job = await job_store.claim(WORKER_ID, RUN_ID, JOB_LEASE)
+                if not job:
+                    break
+                start(job)
+        except Exception as e:
+            logger.error(f"Claiming jobs failed: {e}")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
 
-    status_message = await message.reply_text("🔍 Processing your Terabox link...")
-    
-    # Get direct download link
-    direct_url = await get_terabox_direct_link(url)
-    if not direct_url:
-        await status_message.edit_text("⚠️ Failed to process this Terabox link. Please try another link.")
+async def resume_jobs():
+    jobs = job_journal.pending()
+    if not jobs:
         return
-    
+    # Replies need the bot, which only connects after startup_checks
+    while not app.is_initialized:
+        await asyncio.sleep(1)
+    logger.info(f"Resuming {len(jobs)} jobs interrupted by the last shutdown")
+    results = await asyncio.gather(*(resume_job(job) for job in jobs), return_exceptions=True)
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Resuming job {job['share_id']} failed: {result}")
+
+async def follow_inflight_share(client, message, share_id, inflight, status_message=None):
+    text = "⏳ This link is already being processed, you will get it as soon as it is ready..."
+    if status_message is None:
+        status_message = await message.reply_text(text)
+    else:
+        update_status_message(status_message, text)
+    sent_parts = 0
     try:
-        # Add download to aria2
-        download = aria2.add_uris([direct_url])
-        await status_message.edit_text("⏳ sᴇɴᴅɪɴɢ ʏᴏᴜ ᴛʜᴇ ᴍᴇᴅɪᴀ...🤤")
+        async for msg_id in inflight.follow():
+            stored = await client.get_messages(DUMP_CHAT_ID, msg_id)
+            await client.copy_message(
+                message.chat.id, DUMP_CHAT_ID, msg_id, caption=caption_for_requester(stored.caption, message)
+            )
+            sent_parts += 1
     except Exception as e:
-        logger.error(f"Failed to add download: {e}")
-        await status_message.edit_text("⚠️ Failed to start download. Please try again later.")
-        return
+        logger.error(f"Error following in-flight share {share_id}: {e}")
+    if sent_parts and not inflight.failed:
+        update_status_message(status_message, "✅ Upload completed!", final=True)
+    elif sent_parts:
+        update_status_message(status_message, "⚠️ Some parts failed to upload. Please try again later.", final=True)
+    else:
+        update_status_message(status_message, "⚠️ Download failed. Please try again later.", final=True)
+
+# aria2 exit codes for a link that stopped working: not found, unexpected
+# HTTP status (403/410 from an expired link) and refused authorization
+LINK_ERROR_CODES = {"3", "22", "24"}
+MAX_DOWNLOAD_RECOVERIES = 5
+
+def is_link_error(download):
+    message = download.error_message or ""
+    return str(download.error_code) in LINK_ERROR_CODES or "403" in message or "410" in message
+
+# aria2 reports an empty path until it knows the file name, which aria2p turns into "."
+def get_download_path(download):
+    if not download.files:
+        return None
+    path = str(download.files[0].path)
+    return None if path in ("", ".") else path
+
+async def wait_for_download_status(gid, statuses, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        download = await aria2_rpc.tell_status(gid)
+        if download.status in statuses or time.monotonic() >= deadline:
+            return download
+        await asyncio.sleep(0.5)
+
+# Get a stalled or failed download going again without losing its bytes. A link
+# that expired (HTTP error, or no data for the whole stall window) is resolved
+# again through refresh first. Downloads still in aria2 keep their GID and swap
+# the link with changeUri; failed ones are added again at the same path and
+# aria2 continues from the partial file and its control file.
+async def recover_download(download, direct_url, options, refresh=None):
+    if refresh and (not download.has_failed or is_link_error(download)):
+        try:
+            fresh_url = await refresh()
+        except Exception as e:
+            logger.warning(f"Could not resolve a fresh link for download {download.gid}: {e}")
+            fresh_url = None
+        if fresh_url and fresh_url != direct_url:
+            logger.info(f"Download {download.gid}: switching to a freshly resolved link")
+            direct_url = fresh_url
+
+    if not download.has_failed:
+        try:
+            await aria2_rpc.call("aria2.forcePause", download.gid)
+            paused = await wait_for_download_status(download.gid, ("paused", "error", "complete", "removed"))
+            if paused.status == "paused":
+                await aria2_rpc.call("aria2.changeUri", download.gid, 1, [uri["uri"] for uri in paused.files[0].uris], [direct_url])
+                await aria2_rpc.call("aria2.unpause", download.gid)
+                return await aria2_rpc.tell_status(download.gid), direct_url
+            download = paused
+        except Aria2RPCError as e:
+            logger.warning(f"Could not swap the link of download {download.gid}: {e}")
+        if download.is_complete:
+            return download, direct_url
+        await aria2_rpc.call("aria2.forceRemove", download.gid)
+        await wait_for_download_status(download.gid, ("error", "complete", "removed"))
+
+    # The stopped download keeps its file, so adding it back at the same path resumes it
+    try:
+        await aria2_rpc.call("aria2.removeDownloadResult", download.gid)
+    except Aria2RPCError:
+        pass
+    retry_options = {**options, "continue": "true"}
+    path = get_download_path(download)
+    if path:
+        retry_options.update({"dir": os.path.dirname(path), "out": os.path.basename(path)})
+    return await aria2_rpc.add_uris([direct_url], retry_options), direct_url
+
+# Download a resolved link through aria2, reporting progress until it completes.
+# Batched jobs pass the download they already submitted and report progress
+# themselves, with no status message. refresh resolves a fresh link when the
+# current one expires mid-download.
+async def download_file(direct_url, status_message, message, on_progress=None, download=None, options=None,
+                        refresh=None):
+    user_id = message.from_user.id
+    options = options or get_download_options()
+    if download is None:
+        try:
+            # Add download to aria2
+            download = await aria2_rpc.add_uris([direct_url], options)
+            update_status_message(status_message, "⏳ sᴇɴᴅɪɴɢ ʏᴏᴜ ᴛʜᴇ ᴍᴇᴅɪᴀ...🤤")
+        except Exception as e:
+            logger.error(f"Failed to add download: {e}")
+            update_status_message(status_message, "⚠️ Failed to start download. Please try again later.", final=True)
+            return None
 
     start_time = datetime.now()
-    previous_progress = 0
-    stalled_count = 0
-    update_interval = 10  # seconds
-    last_update = time.time()
+    recoveries = 0
+    download_poller.subscribe(download.gid)
 
     # Monitor download progress
-    while not download.is_complete and stalled_count < 5:
+    while not download.is_complete and recoveries < MAX_DOWNLOAD_RECOVERIES:
         try:
-            await asyncio.sleep(update_interval)
-            download.update()
+            status = await download_poller.next_status(download.gid)
+            if status is None:
+                logger.error(f"Download {download.gid} disappeared from aria2")
+                break
+            download = status
             progress = download.progress
             
-            # Check if download is stalled
-            if progress == previous_progress:
-                stalled_count += 1
-                if stalled_count >= 3:
-                    logger.warning(f"Download appears stalled at {progress}%. Attempting to restart...")
-                    # Try to restart if stalled
-                    aria2.remove([download.gid])
-                    download = aria2.add_uris([direct_url])
-                    stalled_count = 0
-                    previous_progress = 0
-                    continue
-            else:
-                stalled_count = 0
-                previous_progress = progress
+            # Recover if the download failed or the poller saw no bytes arrive
+            # for the whole stall window
+            if download.has_failed or download_poller.is_stalled(download.gid):
+                reason = f"failed ({download.error_code}: {download.error_message})" if download.has_failed else "stalled"
+                logger.warning(f"Download {download.gid} {reason} at {progress:.2f}%, recovering...")
+                download_poller.unsubscribe(download.gid)
+                recoveries += 1
+                download, direct_url = await recover_download(download, direct_url, options, refresh)
+                download_poller.subscribe(download.gid)
+                continue
 
-            current_time = time.time()
-            if current_time - last_update >= update_interval:
-                elapsed_time = datetime.now() - start_time
-                elapsed_minutes, elapsed_seconds = divmod(elapsed_time.seconds, 60)
+            if on_progress:
+                await on_progress(download)
+            if not status_message:
+                continue
 
-                status_text = (
-                    f"┏ ғɪʟᴇɴᴀᴍᴇ: {download.name or 'Downloading...'}\n"
-                    f"┠ [{'★' * int(progress / 10)}{'☆' * (10 - int(progress / 10))}] {progress:.2f}%\n"
-                    f"┠ ᴘʀᴏᴄᴇssᴇᴅ: {format_size(download.completed_length)} ᴏғ {format_size(download.total_length)}\n"
-                    f"┠ sᴛᴀᴛᴜs: 📥 Downloading\n"
-                    f"┠ ᴇɴɢɪɴᴇ: <b><u>Aria2c v1.37.0</u></b>\n"
-                    f"┠ sᴘᴇᴇᴅ: {format_size(download.download_speed)}/s\n"
-                    f"┠ ᴇᴛᴀ: {download.eta} | ᴇʟᴀᴘsᴇᴅ: {elapsed_minutes}m {elapsed_seconds}s\n"
-                    f"┖ ᴜsᴇʀ: <a href='tg://user?id={user_id}'>{message.from_user.first_name}</a> | ɪᴅ: {user_id}\n"
-                )
-                
-                try:
-                    await update_status_message(status_message, status_text)
-                    last_update = current_time
-                except FloodWait as e:
-                    logger.error(f"Flood wait detected! Sleeping for {e.value} seconds")
-                    await asyncio.sleep(e.value)
-                except Exception as e:
-                    logger.error(f"Error updating status: {e}")
+            elapsed_time = datetime.now() - start_time
+            elapsed_minutes, elapsed_seconds = divmod(elapsed_time.seconds, 60)
+
+            status_text = (
+                f"┏ ғɪʟᴇɴᴀᴍᴇ: {download.name or 'Downloading...'}\n"
+                f"┠ [{'★' * int(progress / 10)}{'☆' * (10 - int(progress / 10))}] {progress:.2f}%\n"
+                f"┠ ᴘʀᴏᴄᴇssᴇᴅ: {format_size(download.completed_length)} ᴏғ {format_size(download.total_length)}\n"
+                f"┠ sᴛᴀᴛᴜs: 📥 Downloading\n"
+                f"┠ ᴇɴɢɪɴᴇ: <b><u>Aria2c v1.37.0</u></b>\n"
+                f"┠ sᴘᴇᴇᴅ: {format_size(download.download_speed)}/s\n"
+                f"┠ ᴇᴛᴀ: {download.eta} | ᴇʟᴀᴘsᴇᴅ: {elapsed_minutes}m {elapsed_seconds}s\n"
+                f"┖ ᴜsᴇʀ: <a href='tg://user?id={user_id}'>{message.from_user.first_name}</a> | ɪᴅ: {user_id}\n"
+            )
+            update_status_message(status_message, status_text)
         except Exception as e:
             logger.error(f"Error during download monitoring: {e}")
             await asyncio.sleep(5)
 
-    # Check if download completed successfully
-    if not os.path.exists(download.files[0].path if download.files else ""):
-        await status_message.edit_text("⚠️ Download failed. Please try again later.")
-        return
+    download_poller.unsubscribe(download.gid)
+    elapsed = (datetime.now() - start_time).total_seconds()
+    if download.is_complete:
+        downloads_total.inc(result="complete")
+        download_seconds.observe(elapsed)
+        download_speed.observe(download.total_length / elapsed if elapsed > 0 else 0)
+    else:
+        downloads_total.inc(result="failed")
+    return download
 
-    file_path = download.files[0].path
-    caption = (
-        f"✨ {download.name}\n"
+def build_caption(name, message):
+    user_id = message.from_user.id
+    return (
+        f"✨ {name}\n"
         f"👤 ʟᴇᴇᴄʜᴇᴅ ʙʏ : <a href='tg://user?id={user_id}'>{message.from_user.first_name}</a>\n"
         f"📥 ᴜsᴇʀ ʟɪɴᴋ: tg://user?id={user_id}\n\n"
         "[ᴘᴏᴡᴇʀᴇᴅ ʙʏ ᴊᴇᴛ-ᴍɪʀʀᴏʀ ❤️🚀](https://t.me/JetMirror)"
     )
 
-    last_update_time = time.time()
-    UPDATE_INTERVAL = 10
+# Dump messages name whoever asked first; copies for another user get a caption
+# naming them, keeping the file name and any "Part i/N" line. None keeps the
+# stored caption when it isn't one of ours.
+def caption_for_requester(stored_caption, message):
+    if not stored_caption or not stored_caption.startswith("✨ "):
+        return None
+    lines = stored_caption.split("\n")
+    caption = build_caption(lines[0][len("✨ "):], message)
+    if len(lines) > 1 and lines[-1].startswith("Part "):
+        caption += f"\n\n{lines[-1]}"
+    return caption
+
+# Folder shares: every file is submitted to aria2 in one multicall and downloaded
+# concurrently under the job's download slot. Files are then sent as albums of
+# up to MEDIA_GROUP_SIZE in listing order while later ones are still downloading,
+# and each file is deleted as soon as its album is sent. Files too big for one
+# message go through the normal split pipeline afterwards.
+async def mirror_folder(client, message, url, share_id, files, status_message, inflight, reservation, resume=None):
+    user_id = message.from_user.id
+    # Files delivered before a restart are not fetched again
+    done_files = set(resume["done_files"]) if resume else set()
+    remaining = [f for f in files if f.name not in done_files]
+    oversize = [f for f in remaining if f.size and f.size > SPLIT_SIZE]
+    grouped = [f for f in remaining if f not in oversize]
+    total_size = sum(f.size or 0 for f in files)
+    update_status_message(status_message, f"📂 Folder with {len(files)} files ({format_size(total_size)})")
+
+    try:
+        await reservation.admit(sum(f.size or 0 for f in grouped), status_message)
+    except InsufficientDiskSpace as e:
+        update_status_message(status_message, f"⚠️ {e}. Please try again later.", final=True)
+        return
+
+    # Each file gets its own directory so same-named files can't overwrite each other
+    job_dir = os.path.join(DOWNLOAD_DIR, f"folder-{urllib.parse.quote(share_id, safe='')}")
+    reservation.path = job_dir
+    job_journal.update(share_id, stage="folder", file_path=job_dir)
+    loop = asyncio.get_running_loop()
+    downloaded = [loop.create_future() for _ in grouped]
+    progress = {}
+    failed = False
+
+    async def on_progress(status):
+        progress[status.gid] = (status.completed_length, status.total_length)
+        done = sum(completed for completed, _ in progress.values())
+        reservation.downloaded = done
+        complete = sum(1 for future in downloaded if future.done())
+        update_status_message(
+            status_message,
+            f"📂 Downloading folder: {complete}/{len(grouped)} files\n"
+            f"ᴘʀᴏᴄᴇssᴇᴅ: {format_size(done)} ᴏғ {format_size(sum(total for _, total in progress.values()))}"
+        )
+
+    # Directories follow the listing, so a resumed job finds its partial files again
+    def file_options(index):
+        return {
+            **get_download_options(grouped[index].size, grouped[index].name),
+            "dir": os.path.join(job_dir, str(files.index(grouped[index])))
+        }
+
+    async def fetch(index, download):
+        try:
+            download = await download_file(
+                grouped[index].url, None, message, on_progress, download, file_options(index),
+                lambda: refresh_direct_link(url, grouped[index])
+            )
+        except Exception as e:
+            logger.error(f"Error downloading {grouped[index].name}: {e}")
+            download = None
+        downloaded[index].set_result(download if download and download.is_complete else None)
+
+    async def download_all():
+        try:
+            async with download_stage.slot(user_id, status_message):
+                batch = [([f.url], file_options(index)) for index, f in enumerate(grouped)]
+                fetches = []
+                for index, result in enumerate(await aria2_rpc.add_uris_batch(batch)):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to add {grouped[index].name}: {result}")
+                        downloaded[index].set_result(None)
+                    else:
+                        fetches.append(fetch(index, result))
+                await asyncio.gather(*fetches)
+        except Exception as e:
+            logger.error(f"Folder download error: {e}")
+        finally:
+            for future in downloaded:
+                if not future.done():
+                    future.set_result(None)
+
+    # Videos and documents can't share an album; keep listing order within each
+    def is_video(f):
+        return os.path.splitext(f.name)[1].lower() in VIDEO_EXTENSIONS
+    albums = []
+    for kind_indexes in ([i for i, f in enumerate(grouped) if is_video(f)],
+                         [i for i, f in enumerate(grouped) if not is_video(f)]):
+        albums.extend(kind_indexes[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(kind_indexes), MEDIA_GROUP_SIZE))
+    albums.sort(key=lambda album: album[0])
+
+    async def send_album(items):
+        if len(items) == 1:
+            f, path, size, media = items[0]
+            kind = "video" if is_video(f) else "document"
+            return [await upload_pool.upload(kind, path, size, caption=build_caption(f.name, message), **media)]
+        media_type = InputMediaVideo if is_video(items[0][0]) else InputMediaDocument
+        album_media = [media_type(path, caption=build_caption(f.name, message), **media) for f, path, _, media in items]
+        return await upload_pool.upload("album", album_media, max(size for _, _, size, _ in items))
 
-    async def update_status(message, text):
-        nonlocal last_update_time
-        current_time = time.time()
-        if current_time - last_update_time >= UPDATE_INTERVAL:
+    downloader = asyncio.create_task(download_all())
+    try:
+        for number, album in enumerate(albums, 1):
+            items = []
+            for index in album:
+                download = await downloaded[index]
+                if download is None:
+                    failed = True
+                    continue
+                path = str(download.files[0].path)
+                media = await prepare_video_upload(path) if is_video(grouped[index]) else {}
+                items.append((grouped[index], path, os.path.getsize(path), media))
+            if not items:
+                continue
             try:
-                await message.edit_text(text)
-                last_update_time = current_time
-            except FloodWait as e:
-                logger.warning(f"FloodWait: Sleeping for {e.value}s")
-                await asyncio.sleep(e.value)
-                await update_status(message, text)
+                async with upload_stage.slot(user_id, status_message, size=sum(size for _, _, size, _ in items)):
+                    update_status_message(
+                        status_message, f"📤 Uploading album {number}/{len(albums)} ({len(items)} files)"
+                    )
+                    try:
+                        sent = await send_album(items)
+                        grouped_album = len(sent) > 1
+                    except Exception as e:
+                        # One bad file can sink an album; fall back to plain documents
+                        logger.error(f"Album upload failed, sending files one by one: {e}")
+                        grouped_album = False
+                        sent = []
+                        for f, path, size, _ in items:
+                            sent.append(await upload_pool.upload(
+                                "document", path, size, caption=build_caption(f.name, message)
+                            ))
+                if grouped_album:
+                    await client.copy_media_group(message.chat.id, DUMP_CHAT_ID, sent[0].id)
+                else:
+                    for msg in sent:
+                        await client.copy_message(message.chat.id, DUMP_CHAT_ID, msg.id)
+                for msg in sent:
+                    await inflight.add_part(msg.id)
+                    job_journal.append(share_id, "delivered", msg.id)
+                for f, _, _, _ in items:
+                    job_journal.append(share_id, "done_files", f.name)
             except Exception as e:
-                logger.error(f"Error updating status: {e}")
+                logger.error(f"Error uploading album {number}: {e}")
+                failed = True
+            finally:
+                for _, path, size, media in items:
+                    discard_thumbnail(media)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    reservation.release(size)
+    finally:
+        downloader.cancel()
+        await asyncio.gather(downloader, return_exceptions=True)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    # Big files reuse the single-file pipeline, one after another
+    for f in oversize:
+        delivered_before = len(inflight.message_ids)
+        file_reservation = disk_budget.open()
+        try:
+            await mirror_share(
+                client, message, url, share_id, inflight, file_reservation, direct_url=f.url, record=False, share_file=f
+            )
+        finally:
+            file_reservation.close()
+        if len(inflight.message_ids) == delivered_before:
+            failed = True
+            continue
+        for msg_id in inflight.message_ids[delivered_before:]:
+            job_journal.append(share_id, "delivered", msg_id)
+        job_journal.append(share_id, "done_files", f.name)
+    failed = failed or inflight.failed
+
+    if inflight.message_ids and not failed:
+        dedup_index.add(share_id, f"{len(files)} files", total_size, list(inflight.message_ids))
+        update_status_message(status_message, "✅ Upload completed!", final=True)
+    elif inflight.message_ids:
+        inflight.failed = True
+        update_status_message(status_message, "⚠️ Some files failed to upload. Please try again later.", final=True)
+    else:
+        update_status_message(status_message, "⚠️ Download failed. Please try again later.", final=True)
+
+async def mirror_share(client, message, url, share_id, inflight, reservation, direct_url=None, record=True,
+                       status_message=None, resume=None, share_file=None):
+    user_id = message.from_user.id
+    if status_message is None:
+        status_message = await message.reply_text("🔍 Processing your Terabox link...")
+    else:
+        update_status_message(status_message, "🔍 Processing your Terabox link...")
+
+    # Only whole shares are journaled; folder files reuse this pipeline unrecorded
+    def journal(**fields):
+        if record:
+            job_journal.update(share_id, **fields)
+
+    # After a restart, reattach to the download aria2 restored or upload the
+    # finished file; anything else starts over from a fresh link, and aria2
+    # continues a partial file from its control file
+    resumed_download = None
+    resumed_file = None
+    if resume and resume["stage"] in ("download", "upload") and resume["gid"]:
+        resumed_download = await find_resumable_download(resume["gid"])
+    if resume and resume["stage"] == "upload" and resume["file_path"] and os.path.isfile(resume["file_path"]):
+        resumed_file = resume["file_path"]
+    if resumed_download or resumed_file:
+        direct_url = resume["direct_url"]
+    
+    # Size and name of the file behind direct_url, when the resolver or listing reported them
+    link_info = share_file
+    if direct_url is None:
+        # Folder shares expand to their files; anything else resolves to one direct link
+        async with resolve_stage.slot(user_id, status_message):
+            files = await list_share_files(url)
+            if len(files) <= 1:
+                link_info = await get_terabox_direct_link(url)
+                direct_url = link_info.url
+        if len(files) > 1:
+            await mirror_folder(client, message, url, share_id, files, status_message, inflight, reservation, resume)
+            return
+    if not direct_url:
+        update_status_message(status_message, "⚠️ Failed to process this Terabox link. Please try another link.", final=True)
+        return
+    if not resumed_file:
+        journal(stage="download", direct_url=direct_url)
+
+    # Hold the job until its download and split parts fit on disk; links of
+    # unknown size are sized once aria2 reports the length. Bytes a resumed
+    # job already has on disk don't need new room.
+    if resumed_file:
+        size = os.path.getsize(resumed_file)
+        file_name = os.path.basename(resumed_file)
+        on_disk = size
+    elif resumed_download and resumed_download.total_length:
+        size = resumed_download.total_length
+        file_name = resumed_download.name
+        on_disk = resumed_download.completed_length
+    elif link_info:
+        size = link_info.size
+        file_name = link_info.name
+        on_disk = 0
+    else:
+        size = None
+        file_name = None
+        on_disk = 0
+    if size:
+        try:
+            need = estimate_disk_need(size, file_name)
+            await reservation.admit(need - on_disk, status_message)
+            reservation.resize(need)
+            reservation.downloaded = on_disk
+        except InsufficientDiskSpace as e:
+            update_status_message(status_message, f"⚠️ {e}. Please try again later.", final=True)
+            return
+    disk_sized = False
+    journaled_download = (resume["gid"], resume["file_path"]) if resume else (None, None)
+    
+    start_time = datetime.now()
+    download = None
+    file_path = None
+    caption = None
+
+    # Bytes sent per file or part, summed into one throughput for the whole job
+    upload_started = None
+    uploaded_bytes = {}
 
-    async def upload_progress(current, total):
+    def upload_throughput():
+        elapsed = time.time() - upload_started if upload_started else 0
+        return sum(uploaded_bytes.values()) / elapsed if elapsed > 0 else 0
+
+    async def upload_progress(current, total, key=None):
+        nonlocal upload_started
+        if upload_started is None:
+            upload_started = time.time()
+        uploaded_bytes[key] = current
         progress = (current / total) * 100
         elapsed_time = datetime.now() - start_time
         elapsed_minutes, elapsed_seconds = divmod(elapsed_time.seconds, 60)
 
         status_text = (
-            f"┏ ғɪʟᴇɴᴀᴍᴇ: {download.name}\n"
+            f"┏ ғɪʟᴇɴᴀᴍᴇ: {os.path.basename(file_path)}\n"
             f"┠ [{'★' * int(progress / 10)}{'☆' * (10 - int(progress / 10))}] {progress:.2f}%\n"
             f"┠ ᴘʀᴏᴄᴇssᴇᴅ: {format_size(current)} ᴏғ {format_size(total)}\n"
             f"┠ sᴛᴀᴛᴜs: 📤 Uploading to Telegram\n"
             f"┠ ᴇɴɢɪɴᴇ: <b><u>PyroFork v2.2.11</u></b>\n"
-            f"┠ sᴘᴇᴇᴅ: {format_size(current / elapsed_time.seconds if elapsed_time.seconds > 0 else 0)}/s\n"
+            f"┠ sᴘᴇᴇᴅ: {format_size(upload_throughput())}/s ({UPLOAD_WORKERS} ᴡᴏʀᴋᴇʀs)\n"
             f"┠ ᴇʟᴀᴘsᴇᴅ: {elapsed_minutes}m {elapsed_seconds}s\n"
             f"┖ ᴜsᴇʀ: <a href='tg://user?id={user_id}'>{message.from_user.first_name}</a> | ɪᴅ: {user_id}\n"
         )
-        await update_status(status_message, status_text)
+        update_status_message(status_message, status_text)
 
-    async def split_video_with_ffmpeg(input_path, output_prefix, split_size):
+    async def split_video_with_ffmpeg(input_path, output_prefix, split_size, producer):
+        original_ext = os.path.splitext(input_path)[1].lower() or '.mp4'
+        start_time = datetime.now()
+        
+        # Check if ffprobe is available, if not use file size based splitting
         try:
-            original_ext = os.path.splitext(input_path)[1].lower() or '.mp4'
-            start_time = datetime.now()
-            last_progress_update = time.time()
+            total_duration = await probe_duration(input_path)
+            
+            file_size = os.path.getsize(input_path)
+            if file_size <= split_size:
+                producer.put(input_path)
+                return
             
-            # Check if ffprobe is available, if not use file size based splitting
+            # One ffmpeg pass cuts at keyframes; the segment length targets a byte
+            # size with headroom for VBR, and any part still over the limit is cut again
+            segment_time = total_duration * SEGMENT_HEADROOM * split_size / file_size
+            producer.total = math.ceil(total_duration / segment_time)
+
+            async def on_segment(segment):
+                for part in await enforce_part_size([segment], split_size):
+                    producer.put(part)
+                elapsed = datetime.now() - start_time
+                status_text = (
+                    f"✂️ Splitting {os.path.basename(input_path)}\n"
+                    f"Part {producer.produced_count}/{producer.total}\n"
+                    f"Elapsed: {elapsed.seconds // 60}m {elapsed.seconds % 60}s"
+                )
+                update_status_message(status_message, status_text)
+
+            await segment_video(input_path, f"{output_prefix}.%03d{original_ext}", segment_time, on_segment, producer)
+        except Exception as e:
+            # Parts already handed to the uploader can't be taken back
+            if producer.produced_count:
+                raise
+            logger.error(f"FFmpeg split error, falling back to simple split: {e}")
+            for part in glob.glob(f"{glob.escape(output_prefix)}.[0-9][0-9][0-9]*{original_ext}"):
+                os.remove(part)
+            # If ffmpeg fails, use simple splitting (for non-video files)
+            await simple_split_file(input_path, output_prefix, split_size, producer)
+
+    async def simple_split_file(input_path, output_prefix, split_size, producer):
+        file_size = os.path.getsize(input_path)
+        if file_size <= split_size:
+            producer.put(input_path)
+            return
+        
+        parts = math.ceil(file_size / split_size)
+        producer.total = parts
+        loop = asyncio.get_running_loop()
+        
+        for i in range(parts):
+            offset = i * split_size
+            length = min(split_size, file_size - offset)
+            output_path = f"{output_prefix}.part{i+1:03d}"
+            if VIRTUAL_SPLIT:
+                # Upload the byte range straight from the original file
+                producer.put(FilePart(input_path, offset, length, os.path.basename(output_path)))
+                continue
+            await producer.wait_for_room()
+            status_text = f"✂️ Splitting file (simple) part {i+1}/{parts}"
+            update_status_message(status_message, status_text)
+            await loop.run_in_executor(None, write_file_part, input_path, output_path, offset, length)
+            producer.put(output_path)
+
+    # Parts delivered before a restart are skipped instead of uploaded again
+    delivered_ids = list(resume["delivered"]) if resume else []
+    skip_parts = len(delivered_ids)
+    upload_failed = False
+
+    async def part_landed(msg_id):
+        delivered_ids.append(msg_id)
+        if record:
+            job_journal.append(share_id, "delivered", msg_id)
+        await inflight.add_part(msg_id)
+
+    # Send a file or part to the dump chat through the least-loaded upload session
+    async def send_to_dump(part, file_ext, part_caption, media=None):
+        size = get_part_size(part)
+
+        async def part_progress(current, total):
+            await upload_progress(current, total, get_part_name(part))
+
+        # Byte ranges of a video are not playable on their own, send those as documents
+        if file_ext in VIDEO_EXTENSIONS and not isinstance(part, FilePart):
             try:
-                proc = await asyncio.create_subprocess_exec(
-                    'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1', input_path,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
+                return await upload_pool.upload(
+                    "video", part, size, caption=part_caption, progress=part_progress, **(media or {})
                 )
-                stdout, _ = await proc.communicate()
-                total_duration = float(stdout.decode().strip())
-                
-                file_size = os.path.getsize(input_path)
-                parts = math.ceil(file_size / split_size)
-                
-                if parts == 1:
-                    return [input_path]
-                
-                duration_per_part = total_duration / parts
-                split_files = []
-                
-                for i in range(parts):
-                    current_time = time.time()
-                    if current_time - last_progress_update >= UPDATE_INTERVAL:
-                        elapsed = datetime.now() - start_time
-                        status_text = (
-                            f"✂️ Splitting {os.path.basename(input_path)}\n"
-                            f"Part {i+1}/{parts}\n"
-                            f"Elapsed: {elapsed.seconds // 60}m {elapsed.seconds % 60}s"
-                        )
-                        await update_status(status_message, status_text)
-                        last_progress_update = current_time
-                    
-                    output_path = f"{output_prefix}.{i+1:03d}{original_ext}"
-                    
-                    # Try first with ffmpeg, then with xtra if available
-                    try:
-                        cmd = [
-                            'ffmpeg', '-y', '-ss', str(i * duration_per_part),
-                            '-i', input_path, '-t', str(duration_per_part),
-                            '-c', 'copy', '-map', '0',
-                            '-avoid_negative_ts', 'make_zero',
-                            output_path
-                        ]
-                        
-                        proc = await asyncio.create_subprocess_exec(*cmd)
-                        await proc.wait()
-                    except:
-                        cmd = [
-                            'xtra', '-y', '-ss', str(i * duration_per_part),
-                            '-i', input_path, '-t', str(duration_per_part),
-                            '-c', 'copy', '-map', '0',
-                            '-avoid_negative_ts', 'make_zero',
-                            output_path
-                        ]
-                        
-                        proc = await asyncio.create_subprocess_exec(*cmd)
-                        await proc.wait()
-                    
-                    split_files.append(output_path)
-                
-                return split_files
             except Exception as e:
-                logger.error(f"FFmpeg split error, falling back to simple split: {e}")
-                # If ffmpeg fails, use simple splitting (for non-video files)
-                return await simple_split_file(input_path, output_prefix, split_size)
-                
-        except Exception as e:
-            logger.error(f"Split error: {e}")
-            # If all splitting fails, return original file
-            return [input_path]
+                logger.error(f"Error sending as video: {e}")
+        return await upload_pool.upload(
+            "document", part, size, caption=part_caption, progress=part_progress
+        )
+
+    # Upload parts from a PartProducer concurrently across the upload pool,
+    # delivering them to the user in order as each one lands
+    async def upload_parts(producer, file_ext, splitter=None):
+        nonlocal upload_failed
+        pending = deque()
+
+        async def upload_part(index, part):
+            media = None
+            try:
+                if file_ext in VIDEO_EXTENSIONS and not isinstance(part, FilePart):
+                    media = await prepare_video_upload(part)
+                async with upload_stage.slot(user_id, status_message, size=get_part_size(part)):
+                    update_status_message(
+                        status_message,
+                        f"📤 Uploading part {index}/{producer.total}\n"
+                        f"{get_part_name(part)}"
+                    )
+                    return await send_to_dump(
+                        part, file_ext, f"{caption}\n\nPart {index}/{producer.total}", media
+                    )
+            except Exception as e:
+                logger.error(f"Error uploading part {index}: {e}")
+                return None
+            finally:
+                # Clean up after each part is sent
+                discard_thumbnail(media)
+                reservation.release(remove_part(part, file_path))
+                producer.release()
+
+        async def deliver(index, task):
+            nonlocal upload_failed
+            sent = await task
+            if sent is None:
+                upload_failed = True
+                await message.reply_text(f"⚠️ Failed to upload part {index}. Please try again later.")
+                return
+            await client.copy_message(message.chat.id, DUMP_CHAT_ID, sent.id)
+            await part_landed(sent.id)
 
-    async def simple_split_file(input_path, output_prefix, split_size):
         try:
-            file_size = os.path.getsize(input_path)
-            if file_size <= split_size:
-                return [input_path]
-            
-            parts = math.ceil(file_size / split_size)
-            split_files = []
-            
-            with open(input_path, 'rb') as f:
-                for i in range(parts):
-                    output_path = f"{output_prefix}.part{i+1:03d}"
-                    status_text = f"✂️ Splitting file (simple) part {i+1}/{parts}"
-                    await update_status(status_message, status_text)
-                    
-                    with open(output_path, 'wb') as out:
-                        chunk = f.read(split_size)
-                        if chunk:
-                            out.write(chunk)
-                            split_files.append(output_path)
-            
-            return split_files
+            index = 0
+            async for part in producer:
+                index += 1
+                if index <= skip_parts:
+                    reservation.release(remove_part(part, file_path))
+                    producer.release()
+                    continue
+                pending.append((index, asyncio.create_task(upload_part(index, part))))
+                while len(pending) >= upload_pool.parallelism:
+                    await deliver(*pending.popleft())
+            while pending:
+                await deliver(*pending.popleft())
         except Exception as e:
-            logger.error(f"Simple split error: {e}")
-            return [input_path]
+            logger.error(f"Error in upload loop: {e}")
+            upload_failed = True
+            await message.reply_text("⚠️ An error occurred during upload. Please try again.")
+        finally:
+            # Final cleanup, including parts the splitter produced but we never sent
+            for _, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+            if splitter:
+                splitter.cancel()
+                await asyncio.gather(splitter, return_exceptions=True)
+            for leftover in producer.drain():
+                try:
+                    remove_part(leftover, file_path)
+                except:
+                    pass
 
     async def handle_upload():
+        nonlocal upload_failed
         file_size = os.path.getsize(file_path)
         
         # Check file existence and size
         if not os.path.exists(file_path):
-            await status_message.edit_text("⚠️ File not found after download. Please try again.")
+            update_status_message(status_message, "⚠️ File not found after download. Please try again.", final=True)
             return
             
         if file_size == 0:
-            await status_message.edit_text("⚠️ Downloaded file is empty. Please try again with a different link.")
+            update_status_message(status_message, "⚠️ Downloaded file is empty. Please try again with a different link.", final=True)
             return
         
         if file_size > SPLIT_SIZE:
-            await update_status(
+            update_status_message(
                 status_message,
-                f"✂️ Splitting {download.name} ({format_size(file_size)})"
+                f"✂️ Splitting {os.path.basename(file_path)} ({format_size(file_size)})"
             )
             
             # Get file extension to determine split method
             file_ext = os.path.splitext(file_path)[1].lower()
-            video_extensions = ['.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.mpg', '.mpeg', '.webm']
-            
-            if file_ext in video_extensions:
-                split_files = await split_video_with_ffmpeg(
-                    file_path,
-                    os.path.splitext(file_path)[0],
-                    SPLIT_SIZE
-                )
-            else:
-                split_files = await simple_split_file(
-                    file_path,
-                    os.path.splitext(file_path)[0],
-                    SPLIT_SIZE
-                )
             
-            try:
-                for i, part in enumerate(split_files):
-                    part_caption = f"{caption}\n\nPart {i+1}/{len(split_files)}"
-                    await update_status(
-                        status_message,
-                        f"📤 Uploading part {i+1}/{len(split_files)}\n"
-                        f"{os.path.basename(part)}"
-                    )
-                    
-                    # Use user client if available, otherwise use bot client
-                    try:
-                        if USER_SESSION_STRING and user:
-                            sent = await user.send_video(
-                                DUMP_CHAT_ID, part, 
-                                caption=part_caption,
-                                progress=upload_progress
-                            )
-                            await app.copy_message(
-                                message.chat.id, DUMP_CHAT_ID, sent.id
-                            )
-                        else:
-                            # Determine if it's a video or document
-                            if file_ext in video_extensions:
-                                sent = await client.send_video(
-                                    DUMP_CHAT_ID, part,
-                                    caption=part_caption,
-                                    progress=upload_progress
-                                )
-                                await client.copy_message(
-                                    message.chat.id, DUMP_CHAT_ID, sent.id
-                                )
-                            else:
-                                sent = await client.send_document(
-                                    DUMP_CHAT_ID, part,
-                                    caption=part_caption,
-                                    progress=upload_progress
-                                )
-                                await client.copy_message(
-                                    message.chat.id, DUMP_CHAT_ID, sent.id
-                                )
-                    except Exception as e:
-                        logger.error(f"Error uploading part {i+1}: {e}")
-                        # Try sending as document if video fails
-                        try:
-                            sent = await client.send_document(
-                                DUMP_CHAT_ID, part,
-                                caption=part_caption,
-                                progress=upload_progress
-                            )
-                            await client.copy_message(
-                                message.chat.id, DUMP_CHAT_ID, sent.id
-                            )
-                        except Exception as e2:
-                            logger.error(f"Both methods failed for part {i+1}: {e2}")
-                            await message.reply_text(f"⚠️ Failed to upload part {i+1}. Please try again later.")
-                    
-                    # Clean up after each part is sent
-                    if os.path.exists(part) and part != file_path:
-                        os.remove(part)
-            except Exception as e:
-                logger.error(f"Error in upload loop: {e}")
-                await message.reply_text("⚠️ An error occurred during upload. Please try again.")
-            finally:
-                # Final cleanup
-                for part in split_files:
-                    try:
-                        if os.path.exists(part) and part != file_path:
-                            os.remove(part)
-                    except:
-                        pass
+            # Parts are uploaded as soon as the splitter finalizes them
+            producer = PartProducer(SPLIT_LOOKAHEAD)
+            split = split_video_with_ffmpeg if file_ext in VIDEO_EXTENSIONS else simple_split_file
+
+            async def run_splitter():
+                try:
+                    async with split_stage.slot(user_id, status_message, size=file_size):
+                        split_started = time.monotonic()
+                        await split(file_path, os.path.splitext(file_path)[0], SPLIT_SIZE, producer)
+                        split_seconds.observe(time.monotonic() - split_started)
+                    producer.finish()
+                except Exception as e:
+                    logger.error(f"Split error: {e}")
+                    producer.finish(e)
+
+            splitter = asyncio.create_task(run_splitter())
+            await upload_parts(producer, file_ext, splitter)
+        elif skip_parts:
+            logger.info(f"{os.path.basename(file_path)} was delivered before the restart")
         else:
-            await update_status(
+            update_status_message(
                 status_message,
-                f"📤 Uploading {download.name}\n"
+                f"📤 Uploading {os.path.basename(file_path)}\n"
                 f"Size: {format_size(file_size)}"
             )
             
             # Determine file type
             file_ext = os.path.splitext(file_path)[1].lower()
-            video_extensions = ['.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.mpg', '.mpeg', '.webm']
+            media = await prepare_video_upload(file_path) if file_ext in VIDEO_EXTENSIONS else None
             
-            try:
-                if USER_SESSION_STRING and user:
-                    if file_ext in video_extensions:
-                        try:
-                            sent = await user.send_video(
-                                DUMP_CHAT_ID, file_path,
-                                caption=caption,
-                                progress=upload_progress
-                            )
-                        except Exception as e:
-                            logger.error(f"Error sending as video: {e}")
-                            sent = await user.send_document(
-                                DUMP_CHAT_ID, file_path,
-                                caption=caption,
-                                progress=upload_progress
-                            )
-                    else:
-                        sent = await user.send_document(
-                            DUMP_CHAT_ID, file_path,
-                            caption=caption,
-                            progress=upload_progress
-                        )
-                    
-                    await app.copy_message(
-                        message.chat.id, DUMP_CHAT_ID, sent.id
-                    )
-                else:
-                    if file_ext in video_extensions:
-                        try:
-                            sent = await client.send_video(
-                                DUMP_CHAT_ID, file_path,
-                                caption=caption,
-                                progress=upload_progress
-                            )
-                        except Exception as e:
-                            logger.error(f"Error sending as video: {e}")
-                            sent = await client.send_document(
-                                DUMP_CHAT_ID, file_path,
-                                caption=caption,
-                                progress=upload_progress
-                            )
-                    else:
-                        sent = await client.send_document(
-                            DUMP_CHAT_ID, file_path,
-                            caption=caption,
-                            progress=upload_progress
-                        )
-                    
+            async with upload_stage.slot(user_id, status_message, size=os.path.getsize(file_path)):
+                try:
+                    sent = await send_to_dump(file_path, file_ext, caption, media)
                     await client.copy_message(
                         message.chat.id, DUMP_CHAT_ID, sent.id
                     )
-            except Exception as e:
-                logger.error(f"Upload error: {e}")
-                await message.reply_text("⚠️ Failed to upload file. Please try again later.")
+                    await part_landed(sent.id)
+                except Exception as e:
+                    logger.error(f"Upload error: {e}")
+                    upload_failed = True
+                    await message.reply_text("⚠️ Failed to upload file. Please try again later.")
+                finally:
+                    discard_thumbnail(media)
                 
         # Clean up original file
         if os.path.exists(file_path):
             os.remove(file_path)
 
-    start_time = datetime.now()
-    try:
-        await handle_upload()
-        await status_message.edit_text("✅ Upload completed!")
-    except Exception as e:
-        logger.error(f"Final error: {e}")
+    # Only a whole file goes into the dedup index, never a truncated upload
+    def covers_whole_file(file_size):
+        if download is not None:
+            return download.is_complete and file_size == download.total_length
+        # The upload stage is only journaled once the download completed
+        return bool(resumed_file) and file_size == size
+
+    async def finish_upload(file_size):
         try:
-            await status_message.edit_text(f"⚠️ An error occurred: {str(e)[:200]}")
-        except:
-            pass
+            if not stream_producer:
+                await handle_upload()
+            if upload_started:
+                logger.info(
+                    f"Uploaded {os.path.basename(file_path)} at {format_size(upload_throughput())}/s "
+                    f"({UPLOAD_WORKERS} workers per session)"
+                )
+            if delivered_ids and not upload_failed:
+                if record and covers_whole_file(file_size):
+                    dedup_index.add(share_id, os.path.basename(file_path), file_size, delivered_ids)
+            else:
+                inflight.failed = True
+            update_status_message(status_message, "✅ Upload completed!", final=True)
+        except Exception as e:
+            logger.error(f"Final error: {e}")
+            inflight.failed = True
+            try:
+                update_status_message(status_message, f"⚠️ An error occurred: {str(e)[:200]}", final=True)
+            except:
+                pass
+        if stream_producer and os.path.exists(file_path):
+            os.remove(file_path)
+
+    # Streaming mode: big non-video files are uploaded range by range while aria2
+    # is still downloading, fetching pieces in order so each SPLIT_SIZE range
+    # becomes contiguous on disk as early as possible
+    stream_producer = None
+    stream_task = None
+    streamed_parts = 0
+
+    def can_stream(status):
+        return bool(status.files) and can_stream_upload(status.total_length, str(status.files[0].path))
+
+    async def on_download_progress(status):
+        nonlocal download, file_path, caption, stream_producer, stream_task, streamed_parts, disk_sized
+        nonlocal journaled_download
+        reservation.downloaded = status.completed_length
+        if status.files and status.total_length:
+            reservation.path = str(status.files[0].path)
+            if journaled_download != (status.gid, reservation.path):
+                journaled_download = (status.gid, reservation.path)
+                journal(gid=status.gid, file_path=reservation.path)
+            if not disk_sized:
+                # The real length and name may need more or less than the estimate
+                reservation.resize(estimate_disk_need(status.total_length, status.name))
+                disk_sized = True
+        if stream_producer is None:
+            if not can_stream(status) or not os.path.exists(status.files[0].path):
+                return
+            download = status
+            file_path = str(status.files[0].path)
+            caption = build_caption(status.name, message)
+            stream_producer = PartProducer(SPLIT_LOOKAHEAD)
+            stream_producer.total = math.ceil(status.total_length / SPLIT_SIZE)
+            stream_task = asyncio.create_task(
+                upload_parts(stream_producer, os.path.splitext(file_path)[1].lower())
+            )
+            logger.info(f"Streaming {status.name} to Telegram while it downloads")
+        if str(status.files[0].path) != file_path:
+            return
+        download = status
+        if status.is_complete:
+            ready = status.total_length
+        else:
+            ready = get_contiguous_length(status) - STREAM_SAFETY_MARGIN
+        while streamed_parts < stream_producer.total:
+            offset = streamed_parts * SPLIT_SIZE
+            length = min(SPLIT_SIZE, status.total_length - offset)
+            if offset + length > ready:
+                break
+            part_name = f"{os.path.basename(file_path)}.part{streamed_parts + 1:03d}"
+            stream_producer.put(FilePart(file_path, offset, length, part_name))
+            streamed_parts += 1
+
+    if resumed_file:
+        file_path = resumed_file
+        caption = build_caption(os.path.basename(file_path), message)
+        reservation.path = file_path
+        start_time = datetime.now()
+        await finish_upload(os.path.getsize(file_path))
+        return
+
+    async def refresh():
+        fresh_url = await refresh_direct_link(url, share_file)
+        if fresh_url:
+            journal(direct_url=fresh_url)
+        return fresh_url
+
+    async with download_stage.slot(user_id, status_message):
+        download = await download_file(
+            direct_url, status_message, message, on_download_progress, resumed_download, get_download_options(size, file_name),
+            refresh
+        )
+    if stream_producer:
+        # Hand over the remaining ranges, or stop the uploader if the download failed
+        if download and download.is_complete:
+            await on_download_progress(download)
+            stream_producer.finish()
+        else:
+            stream_producer.finish(RuntimeError("Download failed"))
+        await stream_task
+        if download and download.is_complete:
+            await finish_upload(download.total_length)
+        else:
+            inflight.failed = True
+            update_status_message(status_message, "⚠️ Download failed. Please try again later.", final=True)
+        return
+    if download is None:
+        return
+
+    # A download that gave up or vanished from aria2 leaves a partial file behind
+    if not download.is_complete or not os.path.exists(download.files[0].path if download.files else ""):
+        inflight.failed = True
+        update_status_message(status_message, "⚠️ Download failed. Please try again later.", final=True)
+        return
+
+    file_path = str(download.files[0].path)
+    caption = build_caption(download.name, message)
+    reservation.path = file_path
+    reservation.downloaded = download.completed_length
+    journal(stage="upload", gid=download.gid, file_path=file_path)
+
+    start_time = datetime.now()
+    await finish_upload(os.path.getsize(file_path))
 
     try:
         # Don't delete messages - keep them for troubleshooting
@@ -637,25 +3599,46 @@ flask_app = Flask(__name__)
 def home():
     return render_template("index.html")
 
+stages = [resolve_stage, download_stage, split_stage, upload_stage]
+ARIA2_GLOBAL_STATS = {
+    "downloadSpeed": "download_speed_bytes",
+    "uploadSpeed": "upload_speed_bytes",
+    "numActive": "active",
+    "numWaiting": "waiting",
+    "numStopped": "stopped",
+}
+
+def collect_disk_free():
+    return {(): shutil.disk_usage(DOWNLOAD_DIR).free}
+
+def collect_aria2_stats():
+    stat = dict(download_poller.global_stat)
+    return {(("stat", name),): int(stat[key]) for key, name in ARIA2_GLOBAL_STATS.items() if key in stat}
+
+gauges = [
+    Gauge("terabox_stage_queued", "Jobs waiting for a stage",
+          lambda: {(("stage", s.name),): sum(len(t) for t in list(s.queues.values())) for s in stages}),
+    Gauge("terabox_stage_active", "Jobs running in a stage",
+          lambda: {(("stage", s.name),): s.active for s in stages}),
+    Gauge("terabox_upload_session_active", "Uploads running on each upload session",
+          lambda: {(("session", s.name),): s.active for s in upload_pool.sessions}),
+    Gauge("terabox_download_dir_free_bytes", "Free space in DOWNLOAD_DIR", collect_disk_free),
+    Gauge("terabox_aria2", "aria2 global stats", collect_aria2_stats),
+]
+
+@flask_app.route('/metrics')
+def metrics_endpoint():
+    lines = []
+    for metric in metrics + gauges:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 def run_flask():
     flask_app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
 
 def keep_alive():
     Thread(target=run_flask).start()
 
-async def start_user_client():
-    if user:
-        try:
-            await user.start()
-            logger.info("User client started successfully!")
-        except Exception as e:
-            logger.error(f"Failed to start user client: {e}")
-
-def run_user():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_user_client())
-
 async def check_aria2_server():
     """Check if aria2 server is running, if not start it"""
     try:
@@ -666,12 +3649,16 @@ async def check_aria2_server():
         logger.warning("Aria2 server is not running, attempting to start...")
         try:
             import subprocess
+            # aria2 refuses to start if the input file is missing
+            open(ARIA2_SESSION_FILE, 'a').close()
+            # Same defaults as a running daemon gets from set_global_options;
+            # split and connections are chosen per download
             subprocess.Popen(
                 "aria2c --enable-rpc --rpc-listen-all=true --rpc-allow-origin-all "
-                "--max-concurrent-downloads=10 --max-connection-per-server=10 "
-                "--rpc-max-request-size=1024M --seed-time=0.0 --min-split-size=10M "
-                "--follow-torrent=mem --split=10 "
-                "--daemon=true --allow-overwrite=true",
+                "--max-concurrent-downloads=10 --rpc-max-request-size=1024M --follow-torrent=mem "
+                f"--input-file={ARIA2_SESSION_FILE} --save-session={ARIA2_SESSION_FILE} "
+                "--save-session-interval=30 --daemon=true "
+                + " ".join(shlex.quote(f"--{key}={value}") for key, value in options.items()),
                 shell=True
             )
             await asyncio.sleep(3)
@@ -747,22 +3734,37 @@ async def startup_checks():
         logger.error("Aria2 server check failed")
     
     # Check download directory
-    download_dir = os.environ.get('DOWNLOAD_DIR', '/downloads')
-    if not os.path.exists(download_dir):
+    if not os.path.exists(DOWNLOAD_DIR):
         try:
-            os.makedirs(download_dir)
-            logger.info(f"Created download directory: {download_dir}")
+            os.makedirs(DOWNLOAD_DIR)
+            logger.info(f"Created download directory: {DOWNLOAD_DIR}")
         except Exception as e:
             logger.error(f"Failed to create download directory: {e}")
+
+    # Clear leftovers from earlier runs, then keep sweeping in the background
+    try:
+        await sweep_download_dir()
+    except Exception as e:
+        logger.error(f"Startup sweep of {DOWNLOAD_DIR} failed: {e}")
+    asyncio.create_task(run_janitor())
+
+    # Pick up jobs the last shutdown interrupted once the bot is connected;
+    # workers do that through the shared queue
+    if BOT_ROLE == 'worker':
+        asyncio.create_task(run_worker())
+    else:
+        asyncio.create_task(resume_jobs())
+    if BOT_ROLE == 'ingress':
+        asyncio.create_task(relay_jobs())
     
     # Check API endpoints
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{TERABOX_API_URL}?ping=1") as response:
-                if response.status == 200:
-                    logger.info("Primary API endpoint is responsive")
-                else:
-                    logger.warning(f"Primary API endpoint returned status {response.status}")
+        session = await get_http_session()
+        async with session.get(f"{TERABOX_API_URL}?ping=1") as response:
+            if response.status == 200:
+                logger.info("Primary API endpoint is responsive")
+            else:
+                logger.warning(f"Primary API endpoint returned status {response.status}")
     except Exception as e:
         logger.warning(f"Primary API endpoint check failed: {e}")
 
@@ -774,18 +3776,20 @@ if __name__ == "__main__":
     # Start the Flask web server
     keep_alive()
 
-    # Start the user client if available
-    if user:
-        logger.info("Starting user client...")
-        Thread(target=run_user).start()
+    # Start the user sessions on the bot's loop so the upload pool can drive them all
+    if len(upload_pool.sessions) > 1:
+        logger.info("Starting upload sessions...")
+        loop.run_until_complete(upload_pool.start())
 
     # Log helpful information
     logger.info("======= BOT STARTUP INFO =======")
     logger.info(f"Using Aria2 for downloads")
     logger.info(f"Max split size: {format_size(SPLIT_SIZE)}")
     logger.info(f"User session: {'Available' if USER_SESSION_STRING else 'Not available'}")
+    logger.info(f"Upload sessions: {', '.join(s.name for s in upload_pool.sessions)}")
     logger.info(f"Primary API: {TERABOX_API_URL}")
     logger.info(f"Alternate API: {ALTERNATE_API_URL}")
+    logger.info(f"Resolvers: {', '.join(RESOLVER_URLS)}")
     logger.info("===============================")
     
     # Start the bot